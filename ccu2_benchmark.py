@@ -0,0 +1,119 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Measures what reading the thermostats costs with many devices. The
+# CCU2 is the simulated XML-API from ccu2_sim_lib, so this runs on any
+# Linux box. For every number of devices and way of reading it prints
+# the wall time, the requests, connections and bytes the CCU2 had to
+# serve and the peak memory ccu2_reader.read_device_list needed on top
+# of what the process already had.
+#
+# Ways of reading:
+#   cold       devicelist.cgi and state.cgi, no device list cache yet
+#   warm       state.cgi of the thermostats only, device list cached
+#   statelist  one statelist.cgi request
+#
+
+import os
+import sys
+import time
+import getopt
+import resource
+import tempfile
+import Queue
+import multiprocessing
+import ccu2_lib
+import ccu2_sim_lib
+
+def read_cached(url, cache):
+	# cold the first time, after that the cache file is filled
+	reader = ccu2_lib.ccu2_reader(url, cache)
+	return reader.read_device_list()
+
+def read_statelist(url, cache):
+	reader = ccu2_lib.ccu2_reader(url)
+	return reader.read_device_list(statelist=True)
+
+benchmarks = [
+	("cold", read_cached),
+	("warm", read_cached),
+	("statelist", read_statelist),
+]
+
+def measure(bench, url, cache, results):
+	""" runs in a child process, so peak memory is its own """
+	before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	started = time.time()
+	lines = bench(url, cache)
+	wall = time.time() - started
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+	results.put((wall, len(lines), peak))
+
+def run(name, bench, sim, url, cache):
+	sim.reset_stats()
+	results = multiprocessing.Queue()
+	child = multiprocessing.Process(target=measure,
+		args=(bench, url, cache, results))
+	child.start()
+	child.join()
+	try:
+		wall, lines, peak = results.get(timeout=1)
+	except Queue.Empty:
+		print("%7d %-10s failed" % (len(sim.devices), name))
+		return
+	print("%7d %-10s %9.1f %8d %5d %10d %6d %8d" % (len(sim.devices), name,
+		wall * 1000, sim.requests, sim.connections, sim.bytes, lines, peak))
+
+def usage():
+	print("ccu2_benchmark.py [-h] [-l latency] [-f failure rate] "
+		"[-m error|drop|hang] [devices ...]")
+
+def main(argv):
+	latency = 0.0
+	failure_rate = 0.0
+	failure = 'error'
+
+	try:
+		opts, args = getopt.getopt(argv, "hl:f:m:",
+			[ "help", "latency=", "failures=", "mode=" ])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt in ("-h", "--help"):
+			usage()
+			sys.exit()
+		elif opt in ("-l", "--latency"):
+			latency = float(arg)
+		elif opt in ("-f", "--failures"):
+			failure_rate = float(arg)
+		elif opt in ("-m", "--mode"):
+			if arg not in ccu2_sim_lib.FAILURES:
+				usage()
+				sys.exit(2)
+			failure = arg
+
+	sizes = [int(arg) for arg in args] or [10, 100, 1000]
+
+	print("%7s %-10s %9s %8s %5s %10s %6s %8s" % ("devices", "read",
+		"wall ms", "requests", "conns", "bytes", "lines", "peak KB"))
+	for devices in sizes:
+		sim = ccu2_sim_lib.ccu2_simulator(devices, latency, failure_rate,
+			failure, hang=ccu2_lib.POLL_DEADLINE + 1)
+		url = sim.start()
+		fd, cache = tempfile.mkstemp(suffix='.cache')
+		os.close(fd)
+		os.remove(cache)
+		try:
+			for name, bench in benchmarks:
+				run(name, bench, sim, url, cache)
+		finally:
+			sim.stop()
+			for path in (cache, cache + '.tmp'):
+				if os.path.exists(path):
+					os.remove(path)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
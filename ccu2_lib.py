@@ -6,63 +6,327 @@
 # (c) Frank Haverkamp 2016
 #
 
-import urllib2
-from xml.dom.minidom import parse
-import xml.dom.minidom
+import httplib
+import http_lib
+import file_lib
+import json
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+try:
+	import xml.etree.cElementTree as ElementTree
+except ImportError:
+	import xml.etree.ElementTree as ElementTree
 
 # Default URL for test-purposes
 ccu2_url = 'http://homematic-ccu2/config/xmlapi/'
 
+# state.cgi takes a comma separated list of device ids, at most that
+# many are asked for in one request to keep the URL short
+STATE_IDS_MAX = 50
+
+# The device list hardly ever changes. With a cache file it is only read
+# again after DEVICE_LIST_TTL seconds or when a device has disappeared.
+DEVICE_LIST_TTL = 24 * 3600
+
+# State requests run in parallel on that many threads. Each request may
+# take REQUEST_TIMEOUT seconds, all of them together with devicelist.cgi
+# POLL_DEADLINE.
+POLL_WORKERS = 2
+REQUEST_TIMEOUT = 5
+POLL_DEADLINE = 8
+
+# Shown instead of ':' when a device did not answer in time and its
+# last known value is used
+STALE_MARK = '*'
+
+def temperature_line(name, value, valueunit, stale=False):
+	mark = STALE_MARK if stale else ':'
+	tmp = ("%12s%s %0.1f%s" % (name, mark, float(value), valueunit))
+	return tmp.encode('utf-8')
+
+def parse_devices(source):
+	""" Parse an XML-API document from a file object while it is read.
+	    Returns [(name, ise_id)] of the devices and {device ise_id:
+	    [(value, valueunit)]} of their ACTUAL_TEMPERATURE datapoints.
+	    Each device is dropped from the tree once it is parsed. """
+	devices = []
+	temperatures = {}
+	root = None
+	ise_id = None
+	for event, elem in ElementTree.iterparse(source, ('start', 'end')):
+		if event == 'start':
+			if root is None:
+				root = elem
+			elif elem.tag == 'device':
+				ise_id = elem.get('ise_id')
+				if ise_id is not None:
+					devices.append((elem.get('name', ''), ise_id))
+		elif elem.tag == 'datapoint':
+			if ise_id is not None and \
+					elem.get('type') == 'ACTUAL_TEMPERATURE':
+				temperatures.setdefault(ise_id, []).append(
+					(elem.get('value'), elem.get('valueunit', '')))
+			elem.clear()
+		elif elem.tag == 'device':
+			ise_id = None
+			root.clear()
+	return devices, temperatures
+
 class ccu2_reader:
 	url = ''
 	device_list = []
 
-	def __init__(self, url):
+	def __init__(self, url, cache=None, ttl=DEVICE_LIST_TTL,
+			workers=POLL_WORKERS, timeout=REQUEST_TIMEOUT,
+			deadline=POLL_DEADLINE, history=None):
 		self.url = url
 		self.device_list = []
+		self.history = history
+		self.workers = workers
+		self.timeout = timeout
+		self.deadline = deadline
 
-	def read_device(self, name, ise_id):
+		# last values we got for each device, shown when it doesn't answer
+		self.last_known = {}
+		self.last_devices = []
+
+		# device list as [(name, ise_id)], ids of the devices with an
+		# ACTUAL_TEMPERATURE datapoint (None until we know) and when the
+		# list was fetched or found unchanged. Kept in cache if given.
+		self.cache = cache
+		self.ttl = ttl
+		self.devices = None
+		self.thermostats = None
+		self.checked = 0
+		self.etag = None
+		self.modified = None
+		self.load_cache()
+
+	def load_cache(self):
+		if self.cache is None:
+			return
+		try:
+			with open(self.cache, 'r') as f:
+				state = json.load(f)
+		except (IOError, ValueError):
+			return
+		if state.get('url') != self.url or not state.get('devices'):
+			return
+		self.devices = [tuple(device) for device in state['devices']]
+		if state.get('thermostats') is not None:
+			self.thermostats = set(state['thermostats'])
+		self.checked = state.get('checked', 0)
+		self.etag = state.get('etag')
+		self.modified = state.get('modified')
+
+	def save_cache(self):
+		if self.cache is None:
+			return
+		state = {
+			'url': self.url,
+			'devices': self.devices,
+			'thermostats': sorted(self.thermostats)
+				if self.thermostats is not None else None,
+			'checked': self.checked,
+			'etag': self.etag,
+			'modified': self.modified,
+		}
+		try:
+			with file_lib.atomic_file(self.cache) as f:
+				json.dump(state, f)
+		except (IOError, OSError) as e:
+			print("err: Could not write " + self.cache + ": " + str(e))
+
+	def open(self, script, headers=None, timeout=None, retries=None):
+		""" response of a script of the XML-API, raises IOError or
+		    httplib.HTTPException """
+		if timeout is None:
+			timeout = self.timeout
+		return http_lib.urlopen(self.url + script, headers, timeout, retries)
+
+	def parse(self, script, response):
+		""" devices and temperatures, parsed straight from the response """
 		try:
-			response = urllib2.urlopen(self.url + 'state.cgi?device_id=' +
-				str(ise_id))
-			device_xml = response.read()
-		except URLError as e:
-			print(e.reason)
-
-		DOMTree = xml.dom.minidom.parseString(device_xml)
-		collection = DOMTree.documentElement
-
-		datapoints = collection.getElementsByTagName("datapoint")
-		for datapoint in datapoints:
-			if datapoint.hasAttribute("type"):
-				_type = datapoint.getAttribute("type")
-				if _type == "ACTUAL_TEMPERATURE":
-					value = datapoint.getAttribute("value")
-					valueunit = datapoint.getAttribute("valueunit")
-					tmp = ("%12s: %0.1f%s" % (name, float(value), valueunit))
-					self.device_list.append(tmp.encode('utf-8'))
-
-	def read_device_list(self):
+			return parse_devices(response)
+		except SyntaxError as e:
+			print("err: Bad XML from " + script + ": " + str(e))
+			return None
+		except (IOError, httplib.HTTPException) as e:
+			# includes timeouts while the body is read
+			print("err: Could not read " + script + ": " + str(e))
+			return None
+		finally:
+			response.close()
+
+	def fetch(self, script, timeout=None):
+		""" devices and temperatures in what a script of the XML-API
+		    returns, None on errors """
 		try:
-			response = urllib2.urlopen(self.url + 'devicelist.cgi')
-			ccu2_xml = response.read()
-		except urllib2.URLError as e:
-			print(e.reason)
+			response = self.open(script, timeout=timeout)
+		except (IOError, httplib.HTTPException) as e:
+			print("err: Could not read " + script + ": " + str(e))
+			return None
+		return self.parse(script, response)
+
+	def poll(self, scripts, deadline=None):
+		""" fetch several scripts on up to self.workers threads. Results
+		    in the order of scripts, None for those which failed or did
+		    not finish before deadline, self.deadline from now if None. """
+		if not scripts:
 			return []
+		if deadline is None:
+			deadline = time.time() + self.deadline
+		timeout = self.remaining(deadline)
+		pool = ThreadPool(max(1, min(self.workers, len(scripts))))
+		pending = [pool.apply_async(self.fetch, (script, timeout))
+			for script in scripts]
+		pool.close()
+		results = []
+		for script, result in zip(scripts, pending):
+			try:
+				results.append(result.get(max(0, deadline - time.time())))
+			except multiprocessing.TimeoutError:
+				print("err: Timeout reading " + script)
+				results.append(None)
+			except Exception as e:
+				print("err: Could not read " + script + ": " + str(e))
+				results.append(None)
+		return results
 
-		DOMTree = xml.dom.minidom.parseString(ccu2_xml)
-		collection = DOMTree.documentElement
+	def read_device(self, name, ise_id):
+		result = self.fetch('state.cgi?device_id=' + str(ise_id))
+		if result is None:
+			return
+		devices, temperatures = result
+		for value, valueunit in temperatures.get(str(ise_id), []):
+			self.device_list.append(temperature_line(name, value,
+				valueunit))
 
-		if collection.hasAttribute("deviceList"):
-			print "Root element : %s" % collection.getAttribute("deviceList")
+	def remaining(self, deadline):
+		""" timeout for a request which has to be done by deadline """
+		return max(0.1, min(self.timeout, deadline - time.time()))
+
+	def read_devices(self, deadline=None):
+		""" [(name, ise_id)] of all devices. devicelist.cgi is only asked
+		    again after self.ttl seconds, conditionally if the CCU2 gave
+		    us validators. If it can't be reached before deadline the old
+		    list is used. """
+		now = time.time()
+		if deadline is None:
+			deadline = now + self.deadline
+		if self.devices is not None and now - self.checked < self.ttl:
+			return self.devices
+
+		headers = {}
+		if self.devices is not None:
+			if self.etag:
+				headers['If-None-Match'] = self.etag
+			if self.modified:
+				headers['If-Modified-Since'] = self.modified
+		try:
+			# no retries, they would eat up the time of the state requests
+			response = self.open('devicelist.cgi', headers,
+				self.remaining(deadline), 0)
+		except (IOError, httplib.HTTPException) as e:
+			print("err: Could not read devicelist.cgi: " + str(e))
+			return self.devices or []
+
+		if response.status == 304:
+			response.close()
+			if self.devices is not None:
+				self.checked = now
+				self.save_cache()
+			return self.devices or []
+
+		etag = response.getheader('etag')
+		modified = response.getheader('last-modified')
+		result = self.parse('devicelist.cgi', response)
+		if result is None:
+			return self.devices or []
+		devices, temperatures = result
+		if devices != self.devices:
+			# new topology, find out again which are thermostats
+			self.devices = devices
+			self.thermostats = None
+		self.checked = now
+		self.etag = etag
+		self.modified = modified
+		self.save_cache()
+		return self.devices
+
+	def read_states(self, ise_ids, deadline=None):
+		""" temperatures of several devices and the ids of the devices
+		    which answered. The ids are spread over up to self.workers
+		    parallel requests of at most STATE_IDS_MAX ids, which have to
+		    be done by deadline. """
+		if not ise_ids:
+			return {}, set()
+		per_request = -(-len(ise_ids) // max(1, self.workers))
+		per_request = min(STATE_IDS_MAX, per_request)
+		chunks = [ise_ids[i:i + per_request]
+			for i in range(0, len(ise_ids), per_request)]
+		results = self.poll(['state.cgi?device_id=' +
+			','.join(str(ise_id) for ise_id in ids) for ids in chunks],
+			deadline)
+
+		temperatures = {}
+		answered = set()
+		for ids, result in zip(chunks, results):
+			if result is None:
+				continue
+			devices, states = result
+			temperatures.update(states)
+			found = set(ise_id for name, ise_id in devices)
+			answered |= found
+			# a device we know of is gone, read the device list again
+			if any(str(ise_id) not in found for ise_id in ids):
+				self.checked = 0
+		return temperatures, answered
+
+	def read_device_list(self, statelist=False):
+		""" Lines with the temperature of each thermostat. Names come from
+		    the cached device list and the values of the thermostats from
+		    parallel state.cgi requests, or both from one statelist.cgi
+		    request. Devices which did not answer in time show their last
+		    known value marked with STALE_MARK. All requests together
+		    take at most self.deadline seconds. Fresh values are added
+		    to self.history if there is one. """
+		self.device_list = []
+		now = time.time()
+		deadline = now + self.deadline
+		if statelist:
+			result = self.poll(['statelist.cgi'], deadline)[0]
+			if result is None:
+				devices, temperatures = self.last_devices, {}
+				answered = set()
+			else:
+				devices, temperatures = result
+				answered = set(ise_id for name, ise_id in devices)
+		else:
+			devices = self.read_devices(deadline)
+			ids = [ise_id for name, ise_id in devices
+				if self.thermostats is None or ise_id in self.thermostats]
+			temperatures, answered = self.read_states(ids, deadline)
+			if self.thermostats is None and self.devices and \
+					all(ise_id in answered for ise_id in ids):
+				self.thermostats = set(temperatures)
+				self.save_cache()
+		self.last_devices = devices
 
-		devices = collection.getElementsByTagName("device")
-		for device in devices:
-			if device.hasAttribute("name"):
-				name = device.getAttribute("name")
-			if device.hasAttribute("ise_id"):
-				ise_id = device.getAttribute("ise_id")
-				self.read_device(name, ise_id)
+		for name, ise_id in devices:
+			values = temperatures.get(ise_id)
+			stale = ise_id not in answered
+			if stale:
+				values = self.last_known.get(ise_id)
+			elif values:
+				self.last_known[ise_id] = values
+				if self.history is not None:
+					self.history.record(ise_id, name, now,
+						float(values[0][0]))
+			for value, valueunit in values or []:
+				self.device_list.append(temperature_line(name, value,
+					valueunit, stale))
 
 		return self.device_list
 
@@ -0,0 +1,267 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Stand-in for the XML-API of a Homematic CCU2 with synthetic devices.
+# It serves devicelist.cgi, state.cgi and statelist.cgi below
+# /config/xmlapi/ like the real one, so ccu2_lib can be run against it:
+#
+#   sim = ccu2_sim_lib.ccu2_simulator(devices=100)
+#   url = sim.start()
+#   reader = ccu2_lib.ccu2_reader(url)
+#
+# Every request can be delayed by latency seconds, and failure_rate of
+# them fail: with an HTTP 500 ('error'), by closing the connection
+# ('drop') or by not answering for hang seconds ('hang'). Connections
+# are kept alive and answers gzip compressed if the client asks for it.
+#
+
+import sys
+import time
+import getopt
+import random
+import socket
+import threading
+import urlparse
+import BaseHTTPServer
+import SocketServer
+import gzip
+import StringIO
+from xml.sax.saxutils import quoteattr
+
+FAILURES = ('error', 'drop', 'hang')
+
+# Every THERMOSTAT_EVERY device is something without a temperature
+THERMOSTAT_EVERY = 4
+
+class simulated_device:
+	""" A device with one channel and its datapoints """
+
+	def __init__(self, number, rng):
+		self.ise_id = str(1000 + number * 10)
+		self.thermostat = number % THERMOSTAT_EVERY != THERMOSTAT_EVERY - 1
+		if self.thermostat:
+			self.name = u'Heizung Raum %d' % number
+			self.datapoints = [
+				('ACTUAL_TEMPERATURE', '%.1f' % rng.uniform(16, 24), u'°C'),
+				('SET_TEMPERATURE', '%.1f' % rng.choice((17, 19, 21)), u'°C'),
+				('VALVE_STATE', str(rng.randint(0, 100)), u'%'),
+				('BATTERY_STATE', '%.1f' % rng.uniform(2.2, 3.0), u'V'),
+			]
+		else:
+			self.name = u'Schalter %d' % number
+			self.datapoints = [
+				('STATE', rng.choice(('true', 'false')), u''),
+			]
+
+	def device_xml(self):
+		return u'<device name=%s address="SIM%07d" ise_id="%s" ' \
+			u'interface="BidCos-RF" device_type="HM-CC-RT-DN" ' \
+			u'ready_config="true"><channel name=%s type="0" ' \
+			u'address="SIM%07d:1" ise_id="%d" direction="RECEIVER" ' \
+			u'index="1" visible="true" operate="true"/></device>' % (
+			quoteattr(self.name), int(self.ise_id), self.ise_id,
+			quoteattr(self.name + u':1'), int(self.ise_id),
+			int(self.ise_id) + 1)
+
+	def state_xml(self):
+		channel = int(self.ise_id) + 1
+		points = u''.join(u'<datapoint name=%s type="%s" ise_id="%d" '
+			u'value="%s" valuetype="4" valueunit=%s timestamp="%d"/>' % (
+			quoteattr(u'BidCos-RF.SIM%07d:1.%s' % (int(self.ise_id), kind)),
+			kind, channel + 1 + i, value, quoteattr(unit), int(time.time()))
+			for i, (kind, value, unit) in enumerate(self.datapoints))
+		return u'<device name=%s ise_id="%s" unreach="false" ' \
+			u'config_pending="false"><channel name=%s ise_id="%d">%s' \
+			u'</channel></device>' % (quoteattr(self.name), self.ise_id,
+			quoteattr(self.name + u':1'), channel, points)
+
+def compress(data):
+	buf = StringIO.StringIO()
+	f = gzip.GzipFile(fileobj=buf, mode='wb')
+	f.write(data)
+	f.close()
+	return buf.getvalue()
+
+class simulator_handler(BaseHTTPServer.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# send each answer at once, small writes stall on delayed ACKs
+	wbufsize = -1
+	disable_nagle_algorithm = True
+
+	def log_message(self, *args):
+		pass
+
+	def setup(self):
+		BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+		self.server.simulator.count_connection()
+
+	def do_GET(self):
+		sim = self.server.simulator
+		sim.count(self.path)
+		if sim.latency:
+			time.sleep(sim.latency)
+		failure = sim.failure()
+		if failure == 'drop':
+			self.connection.shutdown(socket.SHUT_RDWR)
+			return
+		if failure == 'hang':
+			time.sleep(sim.hang)
+		if failure == 'error':
+			self.send_error(500, "Simulated failure")
+			return
+
+		url = urlparse.urlparse(self.path)
+		script = url.path.rsplit('/', 1)[-1]
+		query = urlparse.parse_qs(url.query)
+		if script == 'devicelist.cgi':
+			body = sim.devicelist()
+		elif script == 'statelist.cgi':
+			body = sim.statelist()
+		elif script == 'state.cgi' and 'device_id' in query:
+			body = sim.state(query['device_id'][0].split(','))
+		else:
+			self.send_error(404)
+			return
+		body = body.encode('iso-8859-1')
+		gzipped = 'gzip' in self.headers.get('Accept-Encoding', '')
+		if gzipped:
+			body = compress(body)
+		sim.count_bytes(len(body))
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/xml; charset=ISO-8859-1')
+		if gzipped:
+			self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+class simulator_server(SocketServer.ThreadingMixIn,
+		BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+	def handle_error(self, request, client_address):
+		# clients give up on hanging requests, nothing to report then
+		if not isinstance(sys.exc_info()[1], socket.error):
+			BaseHTTPServer.HTTPServer.handle_error(self, request,
+				client_address)
+
+class ccu2_simulator:
+	""" XML-API of a CCU2 with a number of synthetic devices """
+
+	def __init__(self, devices=10, latency=0.0, failure_rate=0.0,
+			failure='error', hang=30.0, seed=1):
+		rng = random.Random(seed)
+		self.devices = [simulated_device(i, rng) for i in range(devices)]
+		self.by_id = dict((device.ise_id, device) for device in self.devices)
+		self.latency = latency
+		self.failure_rate = failure_rate
+		self.failure_mode = failure
+		self.hang = hang
+		self.rng = random.Random(seed)
+		self.lock = threading.Lock()
+		self.server = None
+		self.reset_stats()
+
+	def reset_stats(self):
+		with self.lock:
+			self.requests = 0
+			self.connections = 0
+			self.bytes = 0
+
+	def count(self, path):
+		with self.lock:
+			self.requests += 1
+
+	def count_connection(self):
+		with self.lock:
+			self.connections += 1
+
+	def count_bytes(self, nbytes):
+		with self.lock:
+			self.bytes += nbytes
+
+	def failure(self):
+		""" how this request fails, None if it doesn't """
+		with self.lock:
+			if self.rng.random() < self.failure_rate:
+				return self.failure_mode
+		return None
+
+	def devicelist(self):
+		return u'<?xml version="1.0" encoding="ISO-8859-1" ?><deviceList>' + \
+			u''.join(device.device_xml() for device in self.devices) + \
+			u'</deviceList>'
+
+	def statelist(self):
+		return u'<?xml version="1.0" encoding="ISO-8859-1" ?><stateList>' + \
+			u''.join(device.state_xml() for device in self.devices) + \
+			u'</stateList>'
+
+	def state(self, ise_ids):
+		return u'<?xml version="1.0" encoding="ISO-8859-1" ?><state>' + \
+			u''.join(self.by_id[ise_id].state_xml() for ise_id in ise_ids
+				if ise_id in self.by_id) + \
+			u'</state>'
+
+	def start(self, port=0):
+		""" serve in a thread, returns the XML-API url """
+		self.server = simulator_server(('127.0.0.1', port), simulator_handler)
+		self.server.simulator = self
+		thread = threading.Thread(target=self.server.serve_forever,
+			name="CCU2 Simulator")
+		thread.daemon = True
+		thread.start()
+		return self.url()
+
+	def url(self):
+		return 'http://127.0.0.1:%d/config/xmlapi/' % self.server.server_port
+
+	def stop(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+def usage():
+	print("ccu2_sim_lib.py [-h] [-p port] [-n devices] [-l latency] "
+		"[-f failure rate] [-m error|drop|hang]")
+
+def main(argv):
+	port = 8080
+	devices = 10
+	latency = 0.0
+	failure_rate = 0.0
+	failure = 'error'
+
+	try:
+		opts, args = getopt.getopt(argv, "hp:n:l:f:m:",
+			[ "help", "port=", "devices=", "latency=", "failures=", "mode=" ])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt in ("-h", "--help"):
+			usage()
+			sys.exit()
+		elif opt in ("-p", "--port"):
+			port = int(arg)
+		elif opt in ("-n", "--devices"):
+			devices = int(arg)
+		elif opt in ("-l", "--latency"):
+			latency = float(arg)
+		elif opt in ("-f", "--failures"):
+			failure_rate = float(arg)
+		elif opt in ("-m", "--mode"):
+			if arg not in FAILURES:
+				usage()
+				sys.exit(2)
+			failure = arg
+
+	sim = ccu2_simulator(devices, latency, failure_rate, failure)
+	print("Serving " + sim.start(port))
+	while True:
+		time.sleep(1)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Drives an lcddriver.lcd from its own writer thread. Callers queue
+# their updates and return immediately. Updates for cells which did
+# not reach the display yet are merged, so a new frame replaces a
+# stale one instead of waiting behind it.
+#
+
+import threading
+import collections
+import lcddriver
+
+class display_service:
+	""" Same interface as lcddriver.lcd, but never waits for the bus """
+
+	def __init__(self, lcd):
+		self.lcd = lcd
+		self.queue = collections.deque()
+		self.cond = threading.Condition()
+		self.busy = False
+		self.thread = threading.Thread(target=self.writer,
+			name="Display Writer")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def new_frame(self):
+		return [[None] * lcddriver.LCD_COLS
+			for row in range(lcddriver.LCD_ROWS)]
+
+	def put(self, cells, line, col=0):
+		""" Merge cells into the newest queued frame """
+		with self.cond:
+			if self.queue and self.queue[-1][0] == 'frame':
+				frame = self.queue[-1][1]
+			else:
+				frame = self.new_frame()
+				self.queue.append(('frame', frame))
+			row = frame[line - 1]
+			cells, col = lcddriver.clip_run(cells, col)
+			for col, cell in enumerate(cells, col):
+				row[col] = cell
+			self.cond.notify()
+
+	def call(self, name, *args):
+		""" Queue any other lcd method, in order with the frames """
+		with self.cond:
+			self.queue.append(('call', name, args))
+			self.cond.notify()
+
+	def queue_depth(self):
+		""" Number of frames and commands waiting for the writer """
+		with self.cond:
+			return len(self.queue)
+
+	def flush(self):
+		""" Wait until everything queued so far is on the display """
+		with self.cond:
+			while self.queue or self.busy:
+				self.cond.wait()
+
+	def lcd_display_string(self, string, line):
+		if not isinstance(string, unicode):
+			string = string.decode("utf-8")
+		self.put(string, line)
+
+	def lcd_display_string_at(self, string, line, col):
+		if not isinstance(string, unicode):
+			string = string.decode("utf-8")
+		self.put(string, line, col)
+
+	def message(self, string, line):
+		# raw ROM bytes, kept as str cells
+		self.put(list(string), line)
+
+	def lcd_clear(self):
+		# pending frames are superseded, only blank cells remain
+		with self.cond:
+			calls = [entry for entry in self.queue if entry[0] != 'frame']
+			frame = self.new_frame()
+			for row in frame:
+				row[:] = u' ' * lcddriver.LCD_COLS
+			self.queue.clear()
+			self.queue.extend(calls)
+			self.queue.append(('call', 'lcd_shift_reset', ()))
+			self.queue.append(('frame', frame))
+			self.cond.notify()
+
+	def lcd_load_ring(self, string, ring):
+		if not isinstance(string, unicode):
+			string = string.decode("utf-8")
+		string = string[:lcddriver.LCD_DDRAM_WIDTH]
+		string = string.ljust(lcddriver.LCD_DDRAM_WIDTH)
+		self.put(string[:lcddriver.LCD_COLS], ring + 1)
+		self.put(string[lcddriver.LCD_COLS:], ring + 3)
+
+	def lcd_shift(self, steps=1):
+		self.call('lcd_shift', steps)
+
+	def lcd_shift_reset(self):
+		self.call('lcd_shift_reset')
+
+	def lcd_create_char(self, location, charmap):
+		self.call('lcd_create_char', location, charmap)
+
+	def lcd_create_umlaute(self):
+		self.call('lcd_create_umlaute')
+
+	def lcd_load_glyphs(self, charmaps):
+		self.call('lcd_load_glyphs', charmaps)
+
+	def lcd_release_glyphs(self):
+		self.call('lcd_release_glyphs')
+
+	def lcd_backlight(self, state):
+		self.call('lcd_backlight', state)
+
+	def draw(self, frame):
+		""" Send a frame, runs of text cells are encoded together """
+		runs = []
+		for line, row in enumerate(frame, 1):
+			col = 0
+			while col < len(row):
+				if row[col] is None:
+					col += 1
+					continue
+				start = col
+				kind = type(row[col])
+				while col < len(row) and type(row[col]) is kind:
+					col += 1
+				run = ''.join(row[start:col])
+				if kind is unicode:
+					run = self.lcd.lcd_encode(run)
+				runs.append((run, line, start))
+		self.lcd.lcd_update_runs(runs)
+
+	def writer(self):
+		while True:
+			with self.cond:
+				while not self.queue:
+					self.busy = False
+					self.cond.notify_all()
+					self.cond.wait()
+				entry = self.queue.popleft()
+				self.busy = True
+			try:
+				if entry[0] == 'frame':
+					self.draw(entry[1])
+				else:
+					getattr(self.lcd, entry[1])(*entry[2])
+			except Exception as e:
+				# a bad call must not stop the writer, flush() would hang
+				print("err: LCD write failed: " + str(e))
+			finally:
+				with self.cond:
+					self.busy = False
+					self.cond.notify_all()
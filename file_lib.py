@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Writing files so that a power cut leaves either the old or the new
+# version, never a torn one. The data goes to path + '.tmp', is flushed
+# to disk and then renamed over path:
+#
+#   with file_lib.atomic_file(path, 'wb') as f:
+#       f.write(data)
+#
+# Errors are raised as IOError or OSError, path is then unchanged.
+#
+
+import os
+
+class atomic_file:
+	""" File which replaces path when the with block ends without error """
+
+	def __init__(self, path, mode='w'):
+		self.path = path
+		self.tmp = path + '.tmp'
+		self.file = open(self.tmp, mode)
+
+	def __enter__(self):
+		return self.file
+
+	def __exit__(self, exc_type, exc, tb):
+		if exc_type is not None:
+			self.file.close()
+			try:
+				os.remove(self.tmp)
+			except OSError:
+				pass
+			return False
+		try:
+			self.file.flush()
+			os.fsync(self.file.fileno())
+		finally:
+			self.file.close()
+		os.rename(self.tmp, self.path)
+		sync_dir(self.path)
+		return False
+
+def sync_dir(path):
+	""" flush the directory entry of path, e.g. after a rename """
+	fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+	try:
+		os.fsync(fd)
+	finally:
+		os.close(fd)
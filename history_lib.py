@@ -0,0 +1,246 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# History of the thermostat readings. Every device gets a ring buffer
+# of HISTORY_SIZE samples, timestamps and float32 values in arrays of
+# fixed size, so memory does not grow however long this runs. The
+# buffers are written to a file every HISTORY_SAVE_INTERVAL seconds
+# and read back at startup.
+#
+# The history screen shows each device on 4 lines: name and current
+# value, a sparkline of the last SPARKLINE_SPAN seconds drawn with the
+# bar glyphs in BAR_GLYPHS, its minimum and maximum and the trend.
+#
+
+import json
+import time
+import array
+import threading
+import file_lib
+
+# One week of samples at one poll per minute
+HISTORY_SIZE = 7 * 24 * 60
+HISTORY_SAVE_INTERVAL = 15 * 60
+HISTORY_MAGIC = 'TEMPHIST1\n'
+
+# Time covered by the sparkline and its minimum/maximum, and by the trend
+SPARKLINE_SPAN = 24 * 3600
+TREND_SPAN = 3 * 3600
+
+# Bars for the sparkline, glyph i is i + 1 pixel rows high
+BAR_GLYPHS = [[0b11111 if row >= 7 - i else 0b00000 for row in range(8)]
+	for i in range(8)]
+
+class ring_buffer:
+	""" The last size (timestamp, value) samples, oldest first.
+	    Timestamps are whole seconds and must not go backwards. """
+
+	def __init__(self, size=HISTORY_SIZE):
+		self.size = size
+		self.times = array.array('I', [0]) * size
+		self.values = array.array('f', [0.0]) * size
+		self.head = 0		# slot of the next sample
+		self.count = 0
+
+	def __len__(self):
+		return self.count
+
+	def slot(self, i):
+		""" slot of the i-th oldest sample """
+		return (self.head - self.count + i) % self.size
+
+	def append(self, timestamp, value):
+		timestamp = int(timestamp)
+		if self.count and timestamp < self.times[self.slot(self.count - 1)]:
+			return False
+		self.times[self.head] = timestamp
+		self.values[self.head] = value
+		self.head = (self.head + 1) % self.size
+		self.count = min(self.count + 1, self.size)
+		return True
+
+	def last(self):
+		""" newest (timestamp, value), None if empty """
+		if not self.count:
+			return None
+		i = self.slot(self.count - 1)
+		return self.times[i], self.values[i]
+
+	def first_since(self, since):
+		""" position of the oldest sample at or after since """
+		lo, hi = 0, self.count
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.times[self.slot(mid)] < since:
+				lo = mid + 1
+			else:
+				hi = mid
+		return lo
+
+	def ordered(self, data, since=0):
+		""" samples of data (times or values) since a time, oldest first,
+		    as one or two slices of the array """
+		first = self.first_since(since)
+		n = self.count - first
+		start = self.slot(first)
+		if start + n <= self.size:
+			return [data[start:start + n]]
+		return [data[start:], data[:start + n - self.size]]
+
+	def samples(self, since=0):
+		for i in range(self.first_since(since), self.count):
+			j = self.slot(i)
+			yield self.times[j], self.values[j]
+
+	def minmax(self, since=0):
+		""" (min, max) of the values since a time, None if there are none """
+		parts = [part for part in self.ordered(self.values, since) if part]
+		if not parts:
+			return None
+		return (min(min(part) for part in parts),
+			max(max(part) for part in parts))
+
+	def trend(self, since=0):
+		""" least squares slope of the values since a time in units per
+		    hour, None with less than two samples """
+		samples = list(self.samples(since))
+		if len(samples) < 2:
+			return None
+		t0 = samples[0][0]
+		n = float(len(samples))
+		mean_t = sum(t - t0 for t, v in samples) / n
+		mean_v = sum(v for t, v in samples) / n
+		var = sum((t - t0 - mean_t) ** 2 for t, v in samples)
+		if not var:
+			return None
+		cov = sum((t - t0 - mean_t) * (v - mean_v) for t, v in samples)
+		return cov / var * 3600
+
+	def buckets(self, start, end, n):
+		""" mean value of n equal time slices of start..end, None for
+		    slices without samples. A sample at end is in the last one. """
+		sums = [0.0] * n
+		counts = [0] * n
+		width = float(end - start) / n
+		for t, v in self.samples(start):
+			if t > end:
+				break
+			i = min(int((t - start) / width), n - 1)
+			sums[i] += v
+			counts[i] += 1
+		return [sums[i] / counts[i] if counts[i] else None for i in range(n)]
+
+def sparkline(values, width=20):
+	""" one line of bar glyph codes for values, None is blank """
+	known = [v for v in values if v is not None]
+	if not known:
+		return u' ' * width
+	lo, hi = min(known), max(known)
+	line = u''
+	for v in values[:width]:
+		if v is None:
+			line += u' '
+		elif hi == lo:
+			line += unichr(3)
+		else:
+			line += unichr(int((v - lo) / (hi - lo) * 7 + 0.5))
+	return line
+
+class temperature_history:
+	""" Ring buffers of all devices by ise_id """
+
+	def __init__(self, path=None, size=HISTORY_SIZE,
+			interval=HISTORY_SAVE_INTERVAL):
+		self.path = path
+		self.size = size
+		self.interval = interval
+		self.devices = {}
+		self.names = {}
+		self.order = []
+		self.lock = threading.Lock()
+		self.saved = time.time()
+		self.load()
+
+	def buffer(self, ise_id, name):
+		if ise_id not in self.devices:
+			self.devices[ise_id] = ring_buffer(self.size)
+			self.order.append(ise_id)
+		self.names[ise_id] = name
+		return self.devices[ise_id]
+
+	def record(self, ise_id, name, timestamp, value):
+		""" add a reading, the file is written if it is due """
+		with self.lock:
+			self.buffer(ise_id, name).append(timestamp, value)
+		if self.path and timestamp - self.saved >= self.interval:
+			self.save()
+
+	def load(self):
+		""" read the history file, a missing or broken one is ignored """
+		if self.path is None:
+			return
+		try:
+			with open(self.path, 'rb') as f:
+				if f.readline() != HISTORY_MAGIC:
+					raise ValueError("not a history file")
+				while True:
+					header = f.readline()
+					if not header:
+						break
+					device = json.loads(header)
+					times = array.array('I')
+					values = array.array('f')
+					times.fromstring(f.read(device['count'] * times.itemsize))
+					values.fromstring(f.read(device['count'] *
+						values.itemsize))
+					buffer = self.buffer(device['id'], device['name'])
+					for timestamp, value in zip(times, values):
+						buffer.append(timestamp, value)
+		except IOError:
+			return
+		except (ValueError, KeyError) as e:
+			print("err: Ignoring broken history " + self.path + ": " + str(e))
+
+	def save(self):
+		with self.lock:
+			self.saved = time.time()
+			devices = []
+			for ise_id in self.order:
+				buffer = self.devices[ise_id]
+				devices.append((ise_id, self.names[ise_id], len(buffer),
+					buffer.ordered(buffer.times), buffer.ordered(buffer.values)))
+		try:
+			with file_lib.atomic_file(self.path, 'wb') as f:
+				f.write(HISTORY_MAGIC)
+				for ise_id, name, count, times, values in devices:
+					f.write(json.dumps({ 'id': ise_id, 'name': name,
+						'count': count }) + '\n')
+					for part in times + values:
+						f.write(part.tostring())
+		except (IOError, OSError) as e:
+			print("err: Could not write " + self.path + ": " + str(e))
+
+	def lines(self, now=None, width=20):
+		""" the history screen, 4 lines per device """
+		if now is None:
+			now = time.time()
+		lines = []
+		with self.lock:
+			for ise_id in self.order:
+				buffer = self.devices[ise_id]
+				last = buffer.last()
+				if last is None:
+					continue
+				since = now - SPARKLINE_SPAN
+				values = buffer.buckets(since, now, width)
+				lo, hi = buffer.minmax(since) or (last[1], last[1])
+				trend = buffer.trend(now - TREND_SPAN) or 0.0
+				lines += [
+					u'%-*.*s%5.1f\xb0C' % (width - 7, width - 7,
+						self.names[ise_id], last[1]),
+					sparkline(values, width),
+					u'24h %5.1f..%5.1f\xb0C' % (lo, hi),
+					u'Trend %+4.1f\xb0C/Std' % trend,
+				]
+		return lines
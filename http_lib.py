@@ -0,0 +1,231 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# HTTP client shared by the data sources (CCU2, weather, RSS feeds).
+# Connections are kept open per host and used again for the next
+# request, responses may come gzip compressed, every request has a
+# timeout and failed ones are tried again after a growing pause.
+#
+#   with http_lib.urlopen(url, timeout=5) as response:
+#       parse(response)
+#
+#   body = http_lib.get(url).body
+#
+# HTTP errors (status 400 and up) raise http_error, which like the
+# socket and httplib errors of a broken connection is an IOError or
+# httplib.HTTPException. Redirects are followed, 304 Not Modified is
+# returned like any other response.
+#
+
+import time
+import zlib
+import socket
+import httplib
+import urlparse
+import threading
+
+DEFAULT_TIMEOUT = 10	# seconds per connect or read
+RETRIES = 2		# further attempts after a failed one
+BACKOFF = 0.5		# seconds before the first retry, doubled each time
+POOL_SIZE = 4		# idle connections kept per host
+MAX_REDIRECTS = 5
+
+USER_AGENT = 'RaspberryPi2-LCD/1.0'
+
+class http_error(IOError):
+	""" The server answered with an error status """
+
+	def __init__(self, url, status, reason):
+		IOError.__init__(self, "HTTP Error %d: %s" % (status, reason))
+		self.url = url
+		self.code = status
+		self.reason = reason
+
+class http_response:
+	""" Response of a pooled connection, read it like a file. The
+	    connection goes back to the pool when the body has been read
+	    completely and the response is closed. """
+
+	def __init__(self, client, key, connection, response, url):
+		self.client = client
+		self.key = key
+		self.connection = connection
+		self.response = response
+		self.url = url
+		self.status = response.status
+		self.reason = response.reason
+		self.headers = dict(response.getheaders())
+		self.decoder = None
+		if self.getheader('content-encoding', '').lower() == 'gzip':
+			self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			# read() returns the decoded body, the headers must say so
+			del self.headers['content-encoding']
+			self.headers.pop('content-length', None)
+		self.body = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+	def getheader(self, name, default=None):
+		return self.headers.get(name.lower(), default)
+
+	def read(self, size=-1):
+		""" up to size bytes of the decoded body, '' at its end """
+		if self.decoder is None:
+			if size < 0:
+				return self.response.read()
+			return self.response.read(size)
+		if size < 0:
+			data = self.decoder.unconsumed_tail + self.response.read()
+			return self.decoder.decompress(data) + self.decoder.flush()
+		while True:
+			data = self.decoder.unconsumed_tail
+			if not data:
+				data = self.response.read(size)
+				if not data:
+					return self.decoder.flush()
+			# at most size bytes, the rest stays in unconsumed_tail
+			data = self.decoder.decompress(data, size)
+			if data:
+				return data
+
+	def close(self):
+		if self.connection is None:
+			return
+		if self.response.isclosed() and not self.response.will_close:
+			self.client.release(self.key, self.connection)
+		else:
+			self.connection.close()
+		self.connection = None
+
+class http_client:
+	""" Keeps up to pool_size idle connections per host """
+
+	def __init__(self, timeout=DEFAULT_TIMEOUT, retries=RETRIES,
+			backoff=BACKOFF, pool_size=POOL_SIZE):
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.pool_size = pool_size
+		self.idle = {}
+		self.lock = threading.Lock()
+
+	def connect(self, key, timeout):
+		""" an idle connection to (scheme, host, port) or a new one, and
+		    whether it was used before """
+		with self.lock:
+			idle = self.idle.get(key)
+			if idle:
+				connection = idle.pop()
+				connection.timeout = timeout
+				if connection.sock is not None:
+					connection.sock.settimeout(timeout)
+				return connection, True
+		scheme, host, port = key
+		if scheme == 'https':
+			return httplib.HTTPSConnection(host, port, timeout=timeout), False
+		return httplib.HTTPConnection(host, port, timeout=timeout), False
+
+	def release(self, key, connection):
+		with self.lock:
+			idle = self.idle.setdefault(key, [])
+			if len(idle) < self.pool_size:
+				idle.append(connection)
+				return
+		connection.close()
+
+	def close(self):
+		""" close all idle connections """
+		with self.lock:
+			idle, self.idle = self.idle, {}
+		for connections in idle.values():
+			for connection in connections:
+				connection.close()
+
+	def request(self, url, headers, timeout):
+		""" one GET, a reused connection which turns out to be closed by
+		    the server is replaced once without counting as a retry """
+		parts = urlparse.urlsplit(url)
+		key = (parts.scheme, parts.hostname,
+			parts.port or (443 if parts.scheme == 'https' else 80))
+		path = parts.path or '/'
+		if parts.query:
+			path += '?' + parts.query
+		request_headers = { 'Accept-Encoding': 'gzip',
+			'User-Agent': USER_AGENT }
+		request_headers.update(headers)
+		while True:
+			connection, reused = self.connect(key, timeout)
+			try:
+				connection.request('GET', path, headers=request_headers)
+				response = connection.getresponse()
+			except (socket.error, httplib.HTTPException) as e:
+				connection.close()
+				if reused and not isinstance(e, socket.timeout):
+					continue
+				raise
+			return http_response(self, key, connection, response, url)
+
+	def urlopen(self, url, headers=None, timeout=None, retries=None):
+		""" GET url, following redirects and retrying network errors and
+		    5xx answers. The response must be closed. """
+		if timeout is None:
+			timeout = self.timeout
+		if retries is None:
+			retries = self.retries
+		headers = headers or {}
+		redirects = 0
+		attempt = 0
+		while True:
+			try:
+				response = self.request(url, headers, timeout)
+			except (socket.error, httplib.HTTPException):
+				if attempt >= retries:
+					raise
+				time.sleep(self.backoff * 2 ** attempt)
+				attempt += 1
+				continue
+
+			if response.status in (301, 302, 303, 307, 308) and \
+					response.getheader('location') and \
+					redirects < MAX_REDIRECTS:
+				response.read()
+				response.close()
+				url = urlparse.urljoin(url, response.getheader('location'))
+				redirects += 1
+				continue
+
+			if response.status >= 500 and attempt < retries:
+				response.read()
+				response.close()
+				time.sleep(self.backoff * 2 ** attempt)
+				attempt += 1
+				continue
+
+			if response.status >= 400:
+				response.read()
+				response.close()
+				raise http_error(url, response.status, response.reason)
+			return response
+
+	def get(self, url, headers=None, timeout=None, retries=None):
+		""" like urlopen, with the whole body read into response.body """
+		response = self.urlopen(url, headers, timeout, retries)
+		try:
+			response.body = response.read()
+		finally:
+			response.close()
+		return response
+
+# The client all data sources share
+client = http_client()
+
+def urlopen(url, headers=None, timeout=None, retries=None):
+	return client.urlopen(url, headers, timeout, retries)
+
+def get(url, headers=None, timeout=None, retries=None):
+	return client.get(url, headers, timeout, retries)
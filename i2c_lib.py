@@ -2,38 +2,177 @@
 # I2C Support
 #
 
-import smbus
+import threading
+import heapq
+import itertools
 from time import *
 
+try:
+	import smbus
+except ImportError:
+	smbus = None
+
+# Creates the bus object for a port. Anything providing the methods of
+# smbus.SMBus can be plugged in here, e.g. lcd_sim_lib.virtual_bus.
+bus_factory = smbus.SMBus if smbus else None
+
+# An SMBus i2c block write carries a command byte plus up to 32 data
+# bytes. For a plain output expander like the PCF8574 every one of them
+# is latched to the port, so that is 33 port writes per transaction.
+I2C_BLOCK_MAX = 33
+
+# Shared buses, by port number or by the bus object passed in
+shared_buses = {}
+shared_buses_lock = threading.Lock()
+
+def open_bus(port=1, bus=None):
+	""" Return the i2c_bus shared by all devices on port (or bus) """
+	key = port if bus is None else bus
+	with shared_buses_lock:
+		if key not in shared_buses:
+			if bus is None:
+				if bus_factory is None:
+					raise IOError("No I2C backend, python-smbus is missing")
+				bus = bus_factory(port)
+			shared_buses[key] = i2c_bus(bus)
+		return shared_buses[key]
+
+class i2c_bus:
+	""" One bus shared by several devices and threads. Transactions run
+	    one at a time, waiting ones with higher priority go first. """
+
+	def __init__(self, bus):
+		self.bus = bus
+		self.cond = threading.Condition()
+		self.owner = None
+		self.depth = 0
+		self.waiting = []
+		self.tickets = itertools.count()
+		self.started = 0.0
+		self.stats = {}
+
+	def acquire(self, priority=0):
+		me = threading.current_thread()
+		with self.cond:
+			if self.owner is me:
+				self.depth += 1
+				return
+			ticket = (-priority, next(self.tickets))
+			heapq.heappush(self.waiting, ticket)
+			while self.owner is not None or self.waiting[0] != ticket:
+				self.cond.wait()
+			heapq.heappop(self.waiting)
+			self.owner = me
+			self.depth = 1
+			self.started = time()
+
+	def release(self, addr):
+		with self.cond:
+			self.depth -= 1
+			if self.depth:
+				return
+			self.account(addr, 0, 0, time() - self.started)
+			self.owner = None
+			self.cond.notify_all()
+
+	def account(self, addr, transactions, nbytes, seconds=0.0):
+		stats = self.stats.setdefault(addr, [0, 0, 0.0])
+		stats[0] += transactions
+		stats[1] += nbytes
+		stats[2] += seconds
+
+	def statistics(self):
+		""" {addr: (transactions, bytes, seconds holding the bus)} """
+		with self.cond:
+			return dict((addr, tuple(stats))
+				for addr, stats in self.stats.items())
+
+class i2c_transaction:
+	""" Holds the shared bus for a device, may be nested """
+
+	def __init__(self, device):
+		self.device = device
+
+	def __enter__(self):
+		self.device.shared.acquire(self.device.priority)
+
+	def __exit__(self, *exc):
+		self.device.shared.release(self.device.addr)
+
 class i2c_device:
-	def __init__(self, addr, port=1):
+	def __init__(self, addr, port=1, bus=None, priority=0):
 		self.addr = addr
-		self.bus = smbus.SMBus(port)
+		self.priority = priority
+		self.shared = open_bus(port, bus)
+		self.bus = self.shared.bus
+
+	# Keep the bus for a sequence of accesses: with dev.transaction(): ...
+	def transaction(self):
+		return i2c_transaction(self)
+
+	def account(self, transactions, nbytes):
+		self.shared.account(self.addr, transactions, nbytes)
+
+	# (transactions, bytes, seconds holding the bus) of this device
+	def statistics(self):
+		return self.shared.statistics().get(self.addr, (0, 0, 0.0))
 
 	# Write a single command
 	def write_cmd(self, cmd):
-		self.bus.write_byte(self.addr, cmd)
-		sleep(0.0001)
+		with self.transaction():
+			self.bus.write_byte(self.addr, cmd)
+			self.account(1, 1)
 
 	# Write a command and argument
 	def write_cmd_arg(self, cmd, data):
-		self.bus.write_byte_data(self.addr, cmd, data)
-		sleep(0.0001)
+		with self.transaction():
+			self.bus.write_byte_data(self.addr, cmd, data)
+			self.account(1, 2)
 
 	# Write a block of data
 	def write_block_data(self, cmd, data):
-		self.bus.write_block_data(self.addr, cmd, data)
-		sleep(0.0001)
+		with self.transaction():
+			self.bus.write_block_data(self.addr, cmd, data)
+			self.account(1, 2 + len(data))
+
+	# Write a sequence of raw bytes using as few transactions as possible.
+	# No sleeps here, the bus clock paces the bytes (~90us each at 100kHz).
+	# Groups of unit bytes are never split between two transactions.
+	def write_bytes(self, data, unit=1):
+		data = bytearray(data)
+		size = I2C_BLOCK_MAX - I2C_BLOCK_MAX % unit
+		with self.transaction():
+			for i in range(0, len(data), size):
+				chunk = data[i:i + size]
+				if len(chunk) == 1:
+					self.bus.write_byte(self.addr, chunk[0])
+				else:
+					self.bus.write_i2c_block_data(self.addr, chunk[0],
+						list(chunk[1:]))
+				self.account(1, len(chunk))
+
+	# Wait for the device, a simulated bus may model the delay instead
+	def delay(self, seconds):
+		if hasattr(self.bus, 'delay'):
+			self.bus.delay(seconds)
+		else:
+			sleep(seconds)
 
 	# Read a single byte
 	def read(self):
-		return self.bus.read_byte(self.addr)
+		with self.transaction():
+			self.account(1, 1)
+			return self.bus.read_byte(self.addr)
 
 	# Read
 	def read_data(self, cmd):
-		return self.bus.read_byte_data(self.addr, cmd)
+		with self.transaction():
+			self.account(1, 2)
+			return self.bus.read_byte_data(self.addr, cmd)
 
 	# Read a block of data
 	def read_block_data(self, cmd):
-		return self.bus.read_block_data(self.addr, cmd)
-
+		with self.transaction():
+			data = self.bus.read_block_data(self.addr, cmd)
+			self.account(1, 2 + len(data))
+			return data
@@ -0,0 +1,141 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Measures what the screens of rss_reader.py cost on the I2C bus. The
+# display is the simulated PCF8574/HD44780 from lcd_sim_lib, so this
+# runs on any Linux box. For every screen it prints transactions, bytes,
+# modeled bus time and delays per frame, plus the CPU time spent in
+# Python. It also checks that the simulated DDRAM matches what the
+# driver believes is on the display and counts bytes the controller
+# received while it was still busy.
+#
+
+import sys
+import time
+import getopt
+import lcddriver
+import lcd_sim_lib
+import rss_reader
+
+# A typical post, already formatted by rss_lib
+post = [
+	"18.10 12:00 [1]",
+	"Bundestag berät",
+	"über Haushalt",
+	"Die Abgeordneten",
+	"streiten über die",
+	"Ausgaben für Straßen",
+	"und Brücken. Eine",
+	"Einigung ist nicht",
+	"in Sicht, heißt es.",
+	"Die Grünen fordern",
+	"mehr Geld für Bahn",
+	"und Fahrräder.",
+]
+
+# Its title in one line, as shown by the marquee
+headline = "Bundestag berät über Haushalt"
+
+def bench_banner(lcd, frames):
+	for i in range(frames):
+		rss_reader.lcd_banner(lcd)
+
+def bench_print_text(lcd, frames):
+	for i in range(frames):
+		rss_reader.lcd_print_text(lcd, post)
+
+def bench_scroll_text(lcd, frames):
+	# every frame is one step of the marquee
+	text = [headline, post[0]]
+	for i in range(frames):
+		if i % lcddriver.LCD_DDRAM_WIDTH == 0:
+			rss_reader.lcd_load_scroll_text(lcd, text)
+		lcd.lcd_shift(1)
+
+def bench_bigfont_clock(lcd, frames):
+	rss_reader.lcd_create_bigfont(lcd)
+	lcd.lcd_clear()
+	start = time.mktime((2017, 4, 19, 8, 23, 50, 0, 0, -1))
+	for i in range(frames):
+		# one second per frame, so the seconds digit always changes
+		rss_reader.lcd_bigfont_clock_frame(lcd, time.localtime(start + i))
+
+benchmarks = [
+	("banner", bench_banner),
+	("print_text", bench_print_text),
+	("scroll_text", bench_scroll_text),
+	("bigfont_clock", bench_bigfont_clock),
+]
+
+def check(lcd, bus):
+	""" True if the simulated DDRAM matches the driver's shadow copy """
+	sim = bus.lcd()
+	if sim.shift != lcd.shift:
+		return False
+	for line in range(1, lcddriver.LCD_ROWS + 1):
+		ddram = sim.line(line, lcddriver.LCD_COLS, shifted=False)
+		if ddram != str(lcd.shadow[line - 1]):
+			return False
+	return True
+
+timings = {
+	"fixed": lcddriver.TIMING_FIXED,
+	"busy": lcddriver.TIMING_BUSY,
+	"calibrated": lcddriver.TIMING_CALIBRATED,
+}
+
+def run(name, bench, frames, timing):
+	bus = lcd_sim_lib.virtual_bus()
+	lcd = lcddriver.lcd(bus=bus, timing=timing)
+	if timing == lcddriver.TIMING_CALIBRATED:
+		lcd.lcd_calibrate()
+	bus.reset_stats()
+	cpu = time.clock()
+	bench(lcd, frames)
+	cpu = time.clock() - cpu
+	print("%-14s %6d %8.1f %8.1f %8.2f %8.2f %8.2f %6d  %s" % (name, frames,
+		float(bus.transactions) / frames, float(bus.bytes) / frames,
+		bus.bus_time * 1000 / frames, bus.wait_time * 1000 / frames,
+		cpu * 1000 / frames, bus.lcd().violations,
+		"ok" if check(lcd, bus) else "MISMATCH"))
+
+def usage():
+	print("lcd_benchmark.py [-h] [-n frames] [-t fixed|busy|calibrated] "
+		"[benchmark ...]")
+
+def main(argv):
+	frames = 60
+	timing = lcddriver.TIMING_FIXED
+
+	try:
+		opts, args = getopt.getopt(argv, "hn:t:",
+			[ "help", "frames=", "timing=" ])
+	except getopt.GetoptError:
+		usage()
+		sys.exit(2)
+
+	for opt, arg in opts:
+		if opt in ("-h", "--help"):
+			usage()
+			sys.exit()
+		elif opt in ("-n", "--frames"):
+			frames = int(arg)
+		elif opt in ("-t", "--timing"):
+			if arg not in timings:
+				usage()
+				sys.exit(2)
+			timing = timings[arg]
+
+	# no need to watch the screens
+	rss_reader.REFRESH_TIME = 0
+	rss_reader.BANNER_TIME = 0
+
+	print("%-14s %6s %8s %8s %8s %8s %8s %6s" % ("benchmark", "frames",
+		"trans/f", "bytes/f", "bus ms/f", "wait ms/f", "cpu ms/f", "late"))
+	for name, bench in benchmarks:
+		if not args or name in args:
+			run(name, bench, frames, timing)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Software model of a PCF8574 I2C port expander driving an HD44780
+# LCD controller in 4 bit mode, wired like the usual LCD backpacks:
+#   P0 = RS, P1 = RW, P2 = EN, P3 = backlight, P4..P7 = D4..D7
+#
+# virtual_bus has the methods of smbus.SMBus which i2c_lib uses, so
+# it can be plugged in instead of a real bus:
+#
+#   bus = lcd_sim_lib.virtual_bus()
+#   lcd = lcddriver.lcd(bus=bus)
+#
+# It decodes the nibble and strobe protocol back into DDRAM/CGRAM and
+# counts transactions, bytes and the time they would take on the bus.
+# Delays requested through i2c_device.delay() only advance the modeled
+# clock. Bytes which reach the controller while it is still busy are
+# counted as timing violations.
+#
+
+import errno
+
+# I2C clock of the Raspberry Pi
+BUS_SPEED = 100000	# Hz
+
+# Every transfer costs START, address byte, ACK bits and STOP
+def transfer_bits(nbytes):
+	return 1 + 9 + 9 * nbytes + 1
+
+# Execution times of the controller at 270kHz
+EXEC_TIME = 37e-6
+EXEC_TIME_SLOW = 1.52e-3	# clear display, return home
+EXEC_TIME_DATA = 41e-6
+
+class hd44780:
+	""" Controller state as far as the display contents are concerned """
+
+	def __init__(self):
+		self.ddram = bytearray(' ' * 0x68)
+		self.cgram = bytearray(64)
+		self.ac = 0			# address counter
+		self.cgram_mode = False
+		self.increment = True
+		self.display_shift = False
+		self.shift = 0			# display shift in characters
+		self.display_on = False
+		self.four_bit = False
+		self.nibble = None		# high nibble of a byte in 4 bit mode
+		self.read_low = False		# next status read returns low nibble
+		self.now = 0.0
+		self.busy_until = 0.0
+		self.commands = 0
+		self.chars = 0
+		self.violations = 0
+
+	def execute(self, duration):
+		if self.now < self.busy_until:
+			self.violations += 1
+		self.busy_until = self.now + duration
+
+	def next_ddram(self, addr, step):
+		addr += step
+		if addr == 0x28:
+			addr = 0x40
+		elif addr == 0x68:
+			addr = 0x00
+		elif addr == 0x3f:
+			addr = 0x27
+		elif addr == -1:
+			addr = 0x67
+		return addr
+
+	def move(self, step):
+		if self.cgram_mode:
+			self.ac = (self.ac + step) & 0x3f
+		else:
+			self.ac = self.next_ddram(self.ac, step)
+
+	def command(self, cmd):
+		self.commands += 1
+		self.execute(EXEC_TIME_SLOW if cmd < 0x04 else EXEC_TIME)
+		if cmd & 0x80:
+			self.cgram_mode = False
+			self.ac = cmd & 0x7f
+		elif cmd & 0x40:
+			self.cgram_mode = True
+			self.ac = cmd & 0x3f
+		elif cmd & 0x20:
+			self.four_bit = not cmd & 0x10
+		elif cmd & 0x10:
+			step = 1 if cmd & 0x04 else -1
+			if cmd & 0x08:
+				# moving the display right shows earlier characters
+				self.shift = (self.shift - step) % 40
+			else:
+				self.move(step)
+		elif cmd & 0x08:
+			self.display_on = bool(cmd & 0x04)
+		elif cmd & 0x04:
+			self.increment = bool(cmd & 0x02)
+			self.display_shift = bool(cmd & 0x01)
+		elif cmd & 0x02:
+			self.cgram_mode = False
+			self.ac = 0
+			self.shift = 0
+		elif cmd & 0x01:
+			self.ddram[:] = ' ' * len(self.ddram)
+			self.cgram_mode = False
+			self.ac = 0
+			self.shift = 0
+			self.increment = True
+
+	def data(self, value):
+		self.chars += 1
+		self.execute(EXEC_TIME_DATA)
+		if self.cgram_mode:
+			self.cgram[self.ac] = value & 0x1f
+		else:
+			self.ddram[self.ac] = value
+		step = 1 if self.increment else -1
+		self.move(step)
+		if self.display_shift and not self.cgram_mode:
+			self.shift = (self.shift + step) % 40
+
+	def strobe(self, rs, nibble):
+		""" Falling edge of EN with D4..D7 = nibble """
+		if not self.four_bit:
+			# 8 bit mode, D0..D3 are not connected and read as 0
+			value = nibble << 4
+		elif self.nibble is None:
+			self.nibble = nibble
+			return
+		else:
+			value = (self.nibble << 4) | nibble
+			self.nibble = None
+		if rs:
+			self.data(value)
+		elif value:
+			self.command(value)
+
+	def status(self):
+		""" Busy flag and address counter """
+		busy = 0x80 if self.now < self.busy_until else 0x00
+		return busy | (self.ac & 0x7f)
+
+	def read_nibble(self):
+		""" D4..D7 while EN is high in a read cycle """
+		if self.read_low:
+			return self.status() & 0x0f
+		return self.status() >> 4
+
+	def read_done(self):
+		""" Falling edge of EN in a read cycle """
+		if self.four_bit:
+			self.read_low = not self.read_low
+
+	def line(self, line, width=20, shifted=True):
+		""" Visible characters of a line (1..4) on a 4x20 display """
+		base = (0x00, 0x40, 0x00, 0x40)[line - 1]
+		start = (0, 0, width, width)[line - 1]
+		if shifted:
+			start += self.shift
+		return str(bytearray(self.ddram[base + (start + i) % 40]
+			for i in range(width)))
+
+class pcf8574:
+	""" Port expander with an HD44780 on its pins """
+
+	def __init__(self):
+		self.port = 0xff
+		self.now = 0.0
+		self.byte_time = 0.0
+		self.lcd = hd44780()
+
+	def write(self, value):
+		self.now += self.byte_time
+		self.lcd.now = self.now
+		if self.port & 0x04 and not value & 0x04:
+			if value & 0x02:
+				self.lcd.read_done()
+			else:
+				self.lcd.strobe(value & 0x01, (value >> 4) & 0x0f)
+		self.port = value
+
+	def read(self):
+		self.now += self.byte_time
+		self.lcd.now = self.now
+		value = self.port
+		# in a read cycle the controller drives D4..D7
+		if value & 0x02 and value & 0x04:
+			value = (value & 0x0f) | (self.lcd.read_nibble() << 4)
+		return value
+
+class virtual_bus:
+	""" Stand-in for smbus.SMBus with simulated devices """
+
+	def __init__(self, port=1, devices=None, speed=BUS_SPEED):
+		self.port = port
+		self.devices = devices if devices is not None else { 0x27: pcf8574() }
+		self.speed = speed
+		self.clock = 0.0
+		self.reset_stats()
+
+	def reset_stats(self):
+		self.transactions = 0
+		self.bytes = 0
+		self.bus_time = 0.0
+		self.wait_time = 0.0
+
+	def now(self):
+		""" Modeled time: bus transfers plus requested delays """
+		return self.clock
+
+	def delay(self, seconds):
+		self.clock += seconds
+		self.wait_time += seconds
+
+	def transfer(self, addr, nbytes):
+		if addr not in self.devices:
+			raise IOError(errno.EREMOTEIO, "Remote I/O error")
+		device = self.devices[addr]
+		# the data bytes start after START and the address byte
+		device.now = self.now() + 10.0 / self.speed
+		device.byte_time = 9.0 / self.speed
+		self.transactions += 1
+		self.bytes += nbytes
+		duration = float(transfer_bits(nbytes)) / self.speed
+		self.bus_time += duration
+		self.clock += duration
+		return device
+
+	def write_byte(self, addr, value):
+		self.transfer(addr, 1).write(value)
+
+	def write_byte_data(self, addr, cmd, value):
+		device = self.transfer(addr, 2)
+		device.write(cmd)
+		device.write(value)
+
+	def write_i2c_block_data(self, addr, cmd, vals):
+		device = self.transfer(addr, 1 + len(vals))
+		device.write(cmd)
+		for value in vals:
+			device.write(value)
+
+	def write_block_data(self, addr, cmd, vals):
+		device = self.transfer(addr, 2 + len(vals))
+		for value in [cmd, len(vals)] + list(vals):
+			device.write(value)
+
+	def read_byte(self, addr):
+		return self.transfer(addr, 1).read()
+
+	def read_byte_data(self, addr, cmd):
+		device = self.transfer(addr, 2)
+		device.write(cmd)
+		return device.read()
+
+	def read_block_data(self, addr, cmd):
+		device = self.transfer(addr, 2)
+		device.write(cmd)
+		return [device.read()]
+
+	def lcd(self, addr=0x27):
+		""" The simulated controller behind addr """
+		return self.devices[addr].lcd
+
+if __name__ == "__main__":
+	import lcddriver
+	bus = virtual_bus()
+	lcd = lcddriver.lcd(bus=bus)
+	bus.reset_stats()
+	lcd.lcd_display_string("Hello World", 1)
+	lcd.lcd_display_string("äöüÄÖÜß°", 2)
+	print('01234567890123456789')
+	for line in range(1, 5):
+		print(bus.lcd().line(line))
+	print("%d transactions, %d bytes, %.2f ms" %
+		(bus.transactions, bus.bytes, bus.bus_time * 1000))
@@ -5,12 +5,24 @@
 #
 
 import sys
+import codecs
 import i2c_lib
 from time import *
 
 # LCD Address
 ADDRESS = 0x27
 
+# Display geometry
+LCD_ROWS = 4
+LCD_COLS = 20
+
+# DDRAM address of the first character of each line
+LCD_ROW_OFFSETS = (0x00, 0x40, 0x14, 0x54)
+
+# Each of the two DDRAM lines holds 40 characters. On a 4x20 display
+# line 3 shows the second half of line 1, line 4 that of line 2.
+LCD_DDRAM_WIDTH = 40
+
 # commands
 LCD_CLEARDISPLAY = 0x01
 LCD_RETURNHOME = 0x02
@@ -53,6 +65,21 @@ LCD_5x8DOTS = 0x00
 LCD_BACKLIGHT = 0x08
 LCD_NOBACKLIGHT = 0x00
 
+# Timing modes: fixed worst case delays, polling the busy flag, or
+# delays measured by lcd_calibrate()
+TIMING_FIXED = 0
+TIMING_BUSY = 1
+TIMING_CALIBRATED = 2
+
+# Commands which take 1.52ms, everything else is done in 37us which is
+# less than the bus needs for the next nibble. The fixed delays leave
+# room for a slow oscillator.
+LCD_SLOW_COMMANDS = { LCD_CLEARDISPLAY: 0.002, LCD_RETURNHOME: 0.002,
+	LCD_RETURNHOME | 0x01: 0.002 }
+
+# Give up polling after that many reads, RW might not be connected
+LCD_BUSY_POLLS = 20
+
 En = 0b00000100 # Enable bit
 Rw = 0b00000010 # Read/Write bit
 Rs = 0b00000001 # Register select bit
@@ -85,57 +112,230 @@ Uuml = ( 0b01010,
 		 0b10001,
 		 0b01110 )
 
+# Expander bytes for one nibble: put the data on the bus, raise EN,
+# drop EN again. The controller latches on the falling edge.
+def expand_nibble(data):
+	return [data | LCD_BACKLIGHT,
+			data | En | LCD_BACKLIGHT,
+			(data & ~En) | LCD_BACKLIGHT]
+
+# Expander bytes to transfer one byte in 4 bit mode
+def expand_byte(cmd, mode=0):
+	return (expand_nibble(mode | (cmd & 0xF0)) +
+			expand_nibble(mode | ((cmd << 4) & 0xF0)))
+
+# Expander bytes per LCD byte. Writes are split between transactions
+# only at these boundaries, so a failed one does not leave half a byte.
+LCD_BYTE_SIZE = 6
+
+# Precomputed expander sequences for every byte, one table per mode
+LCD_CMD_TABLE = [str(bytearray(expand_byte(b))) for b in range(256)]
+LCD_DATA_TABLE = [str(bytearray(expand_byte(b, Rs))) for b in range(256)]
+LCD_TABLES = { 0: LCD_CMD_TABLE, Rs: LCD_DATA_TABLE }
+
+# Unicode to character ROM (A00) where it differs from ASCII
+UMLAUTE = {
+	228: 225, # ä
+	246: 239, # ö
+	252: 245, # ü
+	223: 226, # ß
+	196: 0,   # 225, # Ä
+	214: 1,   # 239, # Ö
+	220: 2,   # 245, # Ü
+	176: 223, # °
+}
+
+# Full encoding map, Ä/Ö/Ü fall back to the CGRAM glyphs 0..2
+LCD_ENCODING_MAP = dict((i, i) for i in range(128))
+LCD_ENCODING_MAP.update(UMLAUTE)
+LCD_ENCODING_MAP.update({
+	0xa0: 0x20,     # no-break space
+	0xb5: 0xe4,     # µ
+	0xb7: 0xa5,     # ·
+	0x2013: 0x2d,   # –
+	0x2014: 0x2d,   # —
+	0x2018: 0x27,   # ‘
+	0x2019: 0x27,   # ’
+	0x201a: 0x27,   # ‚
+	0x201c: 0x22,   # “
+	0x201d: 0x22,   # ”
+	0x201e: 0x22,   # „
+	0x2026: '...',  # …
+	0x2190: 0x7f,   # ←
+	0x2192: 0x7e,   # →
+})
+
+# Line and column shown at each DDRAM address
+LCD_ADDR_CELLS = dict((LCD_ROW_OFFSETS[row] + col, (row, col))
+	for row in range(LCD_ROWS) for col in range(LCD_COLS))
+
+# Address counter after writing to addr, in 2 line mode it wraps from
+# the end of the first DDRAM line to the second and back
+def next_ddram_addr(addr):
+	if addr == 0x27:
+		return 0x40
+	if addr == 0x67:
+		return 0x00
+	return addr + 1
+
+# The part of data written at col which is on the display and the
+# column it starts at. Cells left or right of the display are dropped.
+def clip_run(data, col):
+	if col < 0:
+		data, col = data[-col:], 0
+	return data[:max(0, LCD_COLS - col)], col
+
 def convert_umlaute(arg):
-	sw = {
-		228: 225, # ä
-		246: 239, # ö
-		252: 245, # ü
-		223: 226, # ß
-		196: 0,   # 225, # Ä
-		214: 1,   # 239, # Ö
-		220: 2,   # 245, # Ü
-		176: 223, # °
-	}
-	return sw.get(arg, arg)
+	return UMLAUTE.get(arg, arg)
+
+def lcd_encode(string):
+	""" Convert a utf-8 or unicode string into LCD ROM bytes """
+	if not isinstance(string, unicode):
+		string = string.decode("utf-8")
+	return codecs.charmap_encode(string, 'replace', LCD_ENCODING_MAP)[0]
+
+# Characters drawn with a CGRAM glyph, and what to show if no slot is free
+CGRAM_GLYPHS = {
+	196: (Auml, u'A'), # Ä
+	214: (Ouml, u'O'), # Ö
+	220: (Uuml, u'U'), # Ü
+}
+
+def lcd_data(data):
+	""" Expander bytes which write the LCD ROM bytes in data """
+	return ''.join([LCD_DATA_TABLE[b] for b in bytearray(data)])
  
 class lcd:
 	""" Initializes objects and lcd """
-	def __init__(self):
-		self.lcd_device = i2c_lib.i2c_device(ADDRESS)
+	def __init__(self, address=ADDRESS, bus=None, timing=TIMING_FIXED,
+			port=1, priority=0):
+		self.lcd_device = i2c_lib.i2c_device(address, port, bus, priority)
+		self.delays = dict(LCD_SLOW_COMMANDS)
+		self.timing = timing
+
+		# In-memory copy of DDRAM and the current address counter,
+		# None if we do not know where the cursor is. Columns in
+		# unknown may differ from the shadow after a failed write.
+		self.shadow = [bytearray(' ' * LCD_COLS) for row in range(LCD_ROWS)]
+		self.unknown = [set() for row in range(LCD_ROWS)]
+		self.cursor = 0x00
+		self.shift = 0
+
+		# CGRAM residency: bitmap in each slot (None if unknown), pinned
+		# slots which must not be evicted and when a slot was last used
+		self.cgram = [None] * 8
+		self.cgram_pinned = [False] * 8
+		self.cgram_used = [0] * 8
+		self.cgram_clock = 0
 
-		self.lcd_write(0x03)
-		self.lcd_write(0x03)
-		self.lcd_write(0x03)
-		self.lcd_write(0x02)
+		# set when a write failed, the controller may then wait for
+		# the second nibble of a byte
+		self.desynced = False
+		self.lcd_reset()
 
-		self.lcd_write(LCD_FUNCTIONSET | LCD_2LINE | LCD_5x8DOTS | LCD_4BITMODE)
+	# Initialize the controller. It may still be in 8 bit mode or be
+	# off by a nibble after a broken transfer, three times 0x3 gets it
+	# into 8 bit mode from either, 0x2 then into 4 bit mode. The display
+	# is cleared and the glyphs we had in CGRAM are uploaded again.
+	def lcd_reset(self):
+		timing = self.timing
+		# the busy flag can not be read before we are in 4 bit mode
+		self.timing = TIMING_FIXED
+		try:
+			for cmd in (0x03, 0x03, 0x03, 0x02):
+				self.lcd_write(cmd)
+				self.lcd_device.delay(0.005)
+			self.lcd_write(LCD_FUNCTIONSET | LCD_2LINE | LCD_5x8DOTS |
+				LCD_4BITMODE)
+		finally:
+			self.timing = timing
 		self.lcd_write(LCD_DISPLAYCONTROL | LCD_DISPLAYON)
-		self.lcd_write(LCD_CLEARDISPLAY)
+		self.lcd_clear()
 		self.lcd_write(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
-		sleep(0.2)
-		
-		self.lcd_create_umlaute()
+		for slot, charmap in enumerate(self.cgram):
+			if charmap is not None:
+				self.cgram[slot] = None
+				self.lcd_create_char(slot, charmap)
+
+	# initialize the controller again if a write failed since
+	def lcd_resync(self):
+		if self.desynced:
+			self.desynced = False
+			self.lcd_reset()
+
+	# Every write to the controller goes through here. After a failed
+	# one it is initialized again before anything else is sent.
+	def lcd_send(self, data):
+		self.lcd_resync()
+		try:
+			self.lcd_device.write_bytes(data, LCD_BYTE_SIZE)
+		except:
+			self.desynced = True
+			self.cursor = None
+			raise
 
 	def lcd_create_umlaute(self):
-		self.lcd_create_char(0, Auml)
-		self.lcd_create_char(1, Ouml)
-		self.lcd_create_char(2, Uuml)
+		self.lcd_load_glyphs((Auml, Ouml, Uuml))
 
 	# clocks EN to latch command
 	def lcd_strobe(self, data):
-		self.lcd_device.write_cmd(data | En | LCD_BACKLIGHT)
-		sleep(.0005)
-		self.lcd_device.write_cmd(((data & ~En) | LCD_BACKLIGHT))
-		sleep(.0001)
+		self.lcd_send(expand_nibble(data)[1:])
 
 	def lcd_write_four_bits(self, data):
-		self.lcd_device.write_cmd(data | LCD_BACKLIGHT)
-		self.lcd_strobe(data)
+		self.lcd_send(expand_nibble(data))
 
 	# write a command to lcd
 	def lcd_write(self, cmd, mode=0):
-		self.lcd_write_four_bits(mode | (cmd & 0xF0))
-		self.lcd_write_four_bits(mode | ((cmd << 4) & 0xF0))
+		self.lcd_send(LCD_TABLES[mode][cmd])
+		if mode == 0 and cmd in self.delays:
+			self.lcd_wait(cmd)
+
+	# read busy flag (bit 7) and address counter, RS=0 RW=1
+	def lcd_read_status(self):
+		port = 0xF0 | Rw | LCD_BACKLIGHT	# D4..D7 high to read them
+		with self.lcd_device.transaction():
+			self.lcd_send((port, port | En))
+			status = self.lcd_device.read() & 0xF0
+			self.lcd_send((port, port | En))
+			status |= self.lcd_device.read() >> 4
+			self.lcd_device.write_cmd(port)
+		return status
+
+	def lcd_wait_busy(self):
+		for i in range(LCD_BUSY_POLLS):
+			if not self.lcd_read_status() & 0x80:
+				return True
+		return False
+
+	# wait until a slow command is done
+	def lcd_wait(self, cmd):
+		if self.timing == TIMING_BUSY:
+			if self.lcd_wait_busy():
+				return
+			print("err: LCD stays busy, falling back to fixed timing")
+			self.timing = TIMING_FIXED
+			self.delays = dict(LCD_SLOW_COMMANDS)
+		self.lcd_device.delay(self.delays[cmd])
+
+	def lcd_calibrate(self, margin=1.25):
+		""" Find the shortest delays after which the slow commands are done """
+		timing = self.timing
+		self.timing = TIMING_FIXED
+		for cmd in self.delays:
+			delay = LCD_SLOW_COMMANDS[cmd]
+			while delay > 0.0002:
+				trial = delay * 0.75
+				self.lcd_send(LCD_CMD_TABLE[cmd])
+				self.lcd_device.delay(trial)
+				busy = self.lcd_read_status() & 0x80
+				self.lcd_wait_busy()
+				if busy:
+					break
+				delay = trial
+			self.delays[cmd] = min(delay * margin, LCD_SLOW_COMMANDS[cmd])
+		self.timing = timing if timing != TIMING_FIXED else TIMING_CALIBRATED
+		self.lcd_clear()
+		return self.delays
       
 	# turn on/off the lcd backlight
 	def lcd_backlight(self, state):
@@ -148,39 +348,178 @@ class lcd:
 
 	def lcd_create_char(self, location, charmap):
 		location &= 0x7
-		self.lcd_write(LCD_SETCGRAMADDR | (location << 3))
+		charmap = tuple(charmap[:8])
+		if self.cgram[location] == charmap:
+			return
+		self.lcd_send(
+			LCD_CMD_TABLE[LCD_SETCGRAMADDR | (location << 3)] +
+			lcd_data(bytearray(charmap)))
+		self.cgram[location] = charmap
+		# address counter now points into CGRAM
+		self.cursor = None
+
+	# load a set of glyphs into slots 0.. and pin them there
+	def lcd_load_glyphs(self, charmaps):
 		for i in range(8):
-			self.lcd_write(charmap[i], Rs)
+			self.cgram_pinned[i] = i < len(charmaps)
+			if i < len(charmaps):
+				self.lcd_create_char(i, charmaps[i])
+
+	# allow all slots to be evicted again
+	def lcd_release_glyphs(self):
+		self.cgram_pinned = [False] * 8
+
+	def lcd_glyph_visible(self, slot):
+		for row in self.shadow:
+			if slot in row or slot + 8 in row:
+				return True
+		return False
+
+	# pick a slot for a new glyph: empty, then least recently used
+	# among the ones not on screen, then least recently used at all
+	def lcd_glyph_victim(self):
+		free = [i for i in range(8) if not self.cgram_pinned[i]]
+		if not free:
+			return None
+		for i in free:
+			if self.cgram[i] is None:
+				return i
+		hidden = [i for i in free if not self.lcd_glyph_visible(i)]
+		return min(hidden or free, key=lambda i: self.cgram_used[i])
+
+	def lcd_glyph(self, charmap):
+		""" Return the CGRAM slot holding charmap, uploading it if needed """
+		charmap = tuple(charmap)
+		if charmap in self.cgram:
+			slot = self.cgram.index(charmap)
+		else:
+			slot = self.lcd_glyph_victim()
+			if slot is None:
+				return None
+			self.lcd_create_char(slot, charmap)
+		self.cgram_clock += 1
+		self.cgram_used[slot] = self.cgram_clock
+		return slot
+
+	def lcd_encode(self, string):
+		""" Like lcd_encode() but puts glyph characters into CGRAM """
+		if not isinstance(string, unicode):
+			string = string.decode("utf-8")
+		remap = {}
+		for code, (charmap, fallback) in CGRAM_GLYPHS.iteritems():
+			if unichr(code) in string:
+				slot = self.lcd_glyph(charmap)
+				if slot is None:
+					remap[code] = fallback
+				else:
+					remap[code] = unichr(slot)
+		if remap:
+			string = string.translate(remap)
+		return lcd_encode(string)
+
+	# cells of data at line/col which differ from the shadow copy, added
+	# to changes as {DDRAM address: byte}. Cells of earlier runs already
+	# in changes are overwritten. The shadow copy is not touched.
+	def lcd_diff(self, data, line, col=0, changes=None):
+		if changes is None:
+			changes = {}
+		row = line - 1
+		shadow = self.shadow[row]
+		unknown = self.unknown[row]
+		data, col = clip_run(data, col)
+		for col, byte in enumerate(bytearray(data), col):
+			addr = LCD_ROW_OFFSETS[row] + col
+			if shadow[col] != byte or col in unknown or addr in changes:
+				changes[addr] = byte
+		return changes
+
+	# Command sequence writing the changed cells. In DDRAM order the
+	# address counter runs line 1, 3, 2, 4, so adjacent cells, even
+	# across lines, only need the data byte. A set-DDRAM command costs
+	# as much as one character, so rewriting unchanged cells to bridge
+	# a gap never pays off, every gap gets a set-DDRAM command.
+	# Returns the bytes and where the address counter ends up.
+	def lcd_plan(self, changes):
+		buf = []
+		cursor = self.cursor
+		for addr, byte in sorted(changes.items()):
+			if cursor != addr:
+				buf.append(LCD_CMD_TABLE[LCD_SETDDRAMADDR | addr])
+			buf.append(LCD_DATA_TABLE[byte])
+			cursor = next_ddram_addr(addr)
+		return ''.join(buf), cursor
+
+	# write a list of (data, line, col) in one go, skipping unchanged cells.
+	# Shadow copy and cursor follow only once the panel has the bytes, if
+	# the write fails the cells it was meant for are rewritten next time.
+	def lcd_update_runs(self, runs):
+		# a reset clears the display, compare with that
+		self.lcd_resync()
+		changes = {}
+		for data, line, col in runs:
+			self.lcd_diff(data, line, col, changes)
+		if not changes:
+			return
+		data, cursor = self.lcd_plan(changes)
+		try:
+			self.lcd_send(data)
+		except:
+			self.cursor = None
+			for addr in changes:
+				row, col = LCD_ADDR_CELLS[addr]
+				self.unknown[row].add(col)
+			raise
+		for addr, byte in changes.items():
+			row, col = LCD_ADDR_CELLS[addr]
+			self.shadow[row][col] = byte
+			self.unknown[row].discard(col)
+		self.cursor = cursor
+
+	# write only the cells of a line which differ from the shadow copy
+	def lcd_update(self, data, line, col=0):
+		self.lcd_update_runs([(data, line, col)])
 
 	# put string function
 	def lcd_display_string(self, string, line):
-		if line == 1:
-			self.lcd_write(0x80)
-		if line == 2:
-			self.lcd_write(0xC0)
-		if line == 3:
-			self.lcd_write(0x94)
-		if line == 4:
-			self.lcd_write(0xD4)
-	
-		for char in string.decode("utf-8"):
-			char = chr(convert_umlaute(ord(char)))
-			self.lcd_write(ord(char), Rs)
+		self.lcd_update(self.lcd_encode(string), line)
+
+	# put string at any column of a line
+	def lcd_display_string_at(self, string, line, col):
+		self.lcd_update(self.lcd_encode(string), line, col)
 
 	def message(self, string, line):
-		if line == 1:
-			self.lcd_write(0x80)
-		if line == 2:
-			self.lcd_write(0xC0)
-		if line == 3:
-			self.lcd_write(0x94)
-		if line == 4:
-			self.lcd_write(0xD4)
-	
-		for char in string:
-			self.lcd_write(ord(char), Rs)
-
-	# clear lcd and set to home
+		self.lcd_update(string, line)
+
+	# put up to 40 characters into DDRAM line ring (0 or 1), shown on
+	# lines ring + 1 and ring + 3 and moved around with lcd_shift()
+	def lcd_load_ring(self, string, ring):
+		data = self.lcd_encode(string)[:LCD_DDRAM_WIDTH]
+		data = data.ljust(LCD_DDRAM_WIDTH)
+		self.lcd_update_runs([(data[:LCD_COLS], ring + 1, 0),
+			(data[LCD_COLS:], ring + 3, 0)])
+
+	# move the whole display by steps characters, one command each
+	def lcd_shift(self, steps=1):
+		if steps > 0:
+			cmd = LCD_CURSORSHIFT | LCD_DISPLAYMOVE | LCD_MOVELEFT
+		else:
+			cmd = LCD_CURSORSHIFT | LCD_DISPLAYMOVE | LCD_MOVERIGHT
+		self.lcd_send(LCD_CMD_TABLE[cmd] * abs(steps))
+		self.shift = (self.shift + steps) % LCD_DDRAM_WIDTH
+
+	# undo any display shift, DDRAM stays as it is
+	def lcd_shift_reset(self):
+		if self.shift:
+			self.lcd_write(LCD_RETURNHOME)
+			self.cursor = 0x00
+			self.shift = 0
+
+	# clear lcd, this also sets the address counter home
 	def lcd_clear(self):
 		self.lcd_write(LCD_CLEARDISPLAY)
-		self.lcd_write(LCD_RETURNHOME)
+		self.shift = 0
+		for row in self.shadow:
+			row[:] = ' ' * LCD_COLS
+		for row in self.unknown:
+			row.clear()
+		self.cursor = 0x00
@@ -11,119 +11,557 @@ import feedparser
 import time
 import sys
 import getopt
-import html2text
 import re
+import unicodedata
+import HTMLParser
+import htmlentitydefs
+import lcddriver
+import http_lib
+import file_lib
+import hashlib
+import threading
+import json
+import collections
+import calendar
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 url = 'http://www.tagesschau.de/xml/rss2'
 db = 'feeds.db'
 limit = 12 * 3600 * 1000
 
+# Feeds are fetched in parallel by that many threads, each may take
+# FEED_TIMEOUT seconds
+FEED_WORKERS = 4
+FEED_TIMEOUT = 15
+
 #
 # functions to get the current time
 #
 current_time_millis = lambda: int(round(time.time() * 1000))
 current_timestamp = current_time_millis()
 
+def post_hash(post_id):
+	""" Key of a post in the database """
+	if isinstance(post_id, unicode):
+		post_id = post_id.encode('utf-8')
+	return hashlib.sha1(post_id).hexdigest()
+
+def post_key(post):
+	""" Key of a feed entry, its guid if there is one """
+	return post_hash(post.get('id') or post.get('link') or
+		post.get('title', u''))
+
+def is_post_hash(key):
+	return len(key) == 40 and not key.strip('0123456789abcdef')
+
+class post_store:
+	""" Posts we have seen, as post hash -> first seen (ms). The file is
+	    read once into an index, new posts are appended and compact()
+	    drops entries older than limit which left the feed. """
+
+	def __init__(self, path, limit=limit):
+		self.path = path
+		self.limit = limit
+		self.lock = threading.Lock()
+		self.index = {}
+		self.lines = 0
+		self.load()
+
+	def load(self):
+		try:
+			with open(self.path, 'r') as database:
+				for line in database:
+					key, sep, ts = line.rstrip('\n').rpartition('|')
+					try:
+						ts = long(ts)
+					except ValueError:
+						continue
+					# older databases stored the title itself
+					if not is_post_hash(key):
+						key = post_hash(key)
+					if key not in self.index or ts < self.index[key]:
+						self.index[key] = ts
+					self.lines += 1
+		except IOError:
+			pass
+
+	def __contains__(self, key):
+		return key in self.index
+
+	def first_seen(self, key):
+		return self.index.get(key)
+
+	def add(self, keys, timestamp):
+		""" Remember the keys which are not in the store yet """
+		with self.lock:
+			new = [key for key in keys if key not in self.index]
+			if not new:
+				return
+			with open(self.path, 'a') as database:
+				for key in new:
+					database.write(key + '|' + str(timestamp) + '\n')
+					self.index[key] = timestamp
+					self.lines += 1
+
+	def compact(self, keep, now):
+		""" Rewrite the file without entries older than limit,
+		    unless their post is in keep """
+		with self.lock:
+			index = dict((key, ts) for key, ts in self.index.iteritems()
+				if now - ts <= self.limit or key in keep)
+			if len(index) == len(self.index) and self.lines == len(index):
+				return
+			with file_lib.atomic_file(self.path) as database:
+				for key, ts in index.iteritems():
+					database.write(key + '|' + str(ts) + '\n')
+			self.index = index
+			self.lines = len(index)
+
+	def compact_in_background(self, keep, now):
+		compactor = threading.Thread(target=self.compact, args=(keep, now),
+			name="Post Store Compaction")
+		compactor.daemon = True
+		compactor.start()
+		return compactor
+
+class lcd_charmap(dict):
+	""" unicode.translate() table to what the LCD can show: characters
+	    the LCD codec knows stay, the rest is replaced by ASCII """
+
+	def __missing__(self, code):
+		value = lcddriver.LCD_ENCODING_MAP.get(code)
+		if isinstance(value, str):
+			value = unicode(value)
+		elif value is None:
+			# drop accents, e.g. é -> e
+			value = u''.join(c for c in unicodedata.normalize('NFKD',
+				unichr(code)) if ord(c) < 128) or u'?'
+		elif value == code or value >= 0x80 or value < 0x08:
+			value = code
+		self[code] = value
+		return value
+
+lcd_chars = lcd_charmap()
+
+class lcd_formatter(HTMLParser.HTMLParser):
+	""" Turns HTML into lines of at most width LCD characters in a single
+	    pass: tags are stripped, links, images and lists dropped, entities
+	    decoded and the text transliterated and word wrapped. """
+
+	block_tags = set(['p', 'div', 'br', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+		'tr', 'blockquote', 'pre', 'table', 'ul', 'ol'])
+	skip_tags = set(['a', 'li', 'script', 'style', 'img'])
+	words = re.compile(r'\s+|\S+', re.UNICODE)
+
+	def __init__(self, width):
+		HTMLParser.HTMLParser.__init__(self)
+		self.width = width
+		self.lines = []
+		self.line = u''
+		self.word = u''
+		self.skip = 0
+
+	def handle_starttag(self, tag, attrs):
+		if tag in self.skip_tags:
+			if tag != 'img':
+				self.skip += 1
+		elif tag in self.block_tags:
+			self.newline()
+
+	def handle_startendtag(self, tag, attrs):
+		if tag in self.block_tags:
+			self.newline()
+
+	def handle_endtag(self, tag):
+		if tag in self.skip_tags:
+			if self.skip:
+				self.skip -= 1
+		elif tag in self.block_tags:
+			self.newline()
+
+	def handle_data(self, data):
+		if self.skip:
+			return
+		if isinstance(data, str):
+			data = data.decode('utf-8')
+		for token in self.words.findall(data.translate(lcd_chars)):
+			if token[0].isspace():
+				self.end_word()
+			else:
+				self.word += token
+
+	def handle_entityref(self, name):
+		code = htmlentitydefs.name2codepoint.get(name)
+		self.handle_data(unichr(code) if code else u'&' + name + u';')
+
+	def handle_charref(self, name):
+		try:
+			if name[0] in 'xX':
+				code = int(name[1:], 16)
+			else:
+				code = int(name)
+			self.handle_data(unichr(code))
+		except (ValueError, OverflowError):
+			pass
+
+	def end_word(self):
+		word = self.word
+		self.word = u''
+		while len(word) > self.width:
+			self.newline()
+			self.lines.append(word[:self.width])
+			word = word[self.width:]
+		if not word:
+			return
+		if self.line and len(self.line) + 1 + len(word) > self.width:
+			self.lines.append(self.line)
+			self.line = word
+		elif self.line:
+			self.line += u' ' + word
+		else:
+			self.line = word
+
+	def newline(self):
+		self.end_word()
+		if self.line:
+			self.lines.append(self.line)
+			self.line = u''
+
+	def format(self, html):
+		""" utf-8 lines of html, the formatter can be used again """
+		self.feed(html)
+		self.close()
+		self.newline()
+		lines = [line.encode('utf-8') for line in self.lines]
+		self.reset()
+		self.lines = []
+		self.skip = 0
+		return lines
+
+# Number of formatted posts kept, least recently used are dropped
+RENDER_CACHE_SIZE = 64
+
+def content_hash(title, description):
+	""" Key of a post's formatted text """
+	text = title + u'\0' + description
+	return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+class rendered_post(list):
+	""" Lines of a formatted post. headline is its title in one line,
+	    for the marquee. """
+	headline = None
+
+class post_list:
+	""" List of posts which are only formatted when taken out. Entries
+	    are (post key, count, title, description). """
+
+	def __init__(self, reader):
+		self.reader = reader
+		self.entries = []
+
+	def append(self, entry):
+		self.entries.append(entry)
+
+	def __len__(self):
+		return len(self.entries)
+
+	def __getitem__(self, i):
+		return self.reader.render(self.entries[i])
+
+	def pop(self, i=-1):
+		return self.reader.render(self.entries.pop(i))
+
+	def __iter__(self):
+		for entry in list(self.entries):
+			yield self.reader.render(entry)
+
+def normalize_title(title):
+	""" Title reduced to lower case words, to spot the same story in
+	    several feeds """
+	return u' '.join(re.findall(r'\w+', title.lower(), re.UNICODE))
+
+def post_published(post):
+	""" Publish time of a feed entry in seconds, 0 if unknown """
+	published = post.get('published_parsed') or post.get('updated_parsed')
+	return calendar.timegm(published) if published else 0
+
 class rss_reader:
 	url = ''
 	db = ''
 	text_list = []
 	width = 20
 
-	def __init__(self, url, db, width=20):
-		self.url = url
+	def __init__(self, url, db, width=20, workers=FEED_WORKERS,
+			timeout=FEED_TIMEOUT):
+		# one feed url or a list of them
+		if isinstance(url, basestring):
+			self.urls = [url]
+		else:
+			self.urls = list(url)
+		self.url = self.urls[0]
 		self.db = db
-		self.text_list = []
+		self.text_list = post_list(self)
 		self.width = width
+		self.workers = workers
+		self.timeout = timeout
+		self.store = post_store(db)
+		self.render_cache = collections.OrderedDict()
+		self.render_lock = threading.Lock()
+
+		# per feed HTTP validators and entries of the last fetch as
+		# (key, published, title, description), kept next to the
+		# database to survive restarts
+		self.cache = db + '.cache'
+		self.feeds = {}
+		self.load_cache()
+
+	def first_seen(self, entry):
+		""" when a post was first seen (ms), None if never. Databases
+		    from before post keys only have the hash of its title, such
+		    an entry is copied to the post key. """
+		key, published, title, description = entry
+		ts = self.store.first_seen(key)
+		if ts is None:
+			ts = self.store.first_seen(post_hash(title))
+			if ts is not None:
+				self.store.add([key], ts)
+		return ts
 
-	def post_is_in_db(self, title):
-		""" Check if title is already in database """
+	def load_cache(self):
+		""" HTTP validators and entries of the last fetch """
 		try:
-			with open(self.db, 'r') as database:
-				for line in database:
-					if title in line:
-						return True
-		except:
-			return False
-		return False
-
-	def post_is_in_db_with_old_timestamp(self, title):
-		""" true if the title is in the db with timestamp > limit """
+			with open(self.cache, 'r') as f:
+				state = json.load(f)
+		except (IOError, ValueError):
+			return
+		feeds = state.get('feeds', {})
+		for url in self.urls:
+			if url in feeds:
+				feed = feeds[url]
+				feed['entries'] = [tuple(entry) for entry in feed['entries']]
+				self.feeds[url] = feed
+
+	def save_cache(self):
+		state = { 'feeds': self.feeds }
 		try:
-			with open(self.db, 'r') as database:
-				for line in database:
-					if title in line:
-						ts_as_string = line.split('|', 1)[1]
-						ts = long(ts_as_string)
-						if current_timestamp - ts > limit:
-							return True
-		except:
-			return False
-		return False
+			with file_lib.atomic_file(self.cache) as f:
+				json.dump(state, f)
+		except (IOError, OSError) as e:
+			print("err: Could not write " + self.cache + ": " + str(e))
 
-	def parse_feeds(self):
-		""" get the feed data from the url """
-		feed = feedparser.parse(self.url)
+	def fetch(self, url):
+		""" get a feed, conditional if we can reuse its last entries """
+		headers = {}
+		last = self.feeds.get(url)
+		if last is not None:
+			if last['etag']:
+				headers['If-None-Match'] = last['etag']
+			if last['modified']:
+				headers['If-Modified-Since'] = last['modified']
+		with http_lib.urlopen(url, headers, self.timeout) as response:
+			feed = feedparser.parse(response,
+				response_headers=response.headers)
+			feed['status'] = response.status
+			feed['etag'] = response.getheader('etag')
+			feed['modified'] = response.getheader('last-modified')
+		return feed
+
+	def update_feed(self, url, feed):
+		""" remember the entries of a fetched feed """
+		# network error, keep what we have
+		if 'status' not in feed and not feed.entries:
+			return
+		# not modified, the last entries are still valid
+		if feed.get('status') == 304 and url in self.feeds:
+			return
+		self.feeds[url] = {
+			'etag': feed.get('etag'),
+			'modified': feed.get('modified'),
+			'entries': [(post_key(post), post_published(post),
+				post.get('title', u''), post.get('description', u''))
+				for post in feed.entries],
+		}
+
+	def fetch_all(self):
+		""" fetch all feeds in parallel, each within self.timeout """
+		workers = max(1, min(self.workers, len(self.urls)))
+		pool = ThreadPool(workers)
+		started = time.time()
+		results = [(url, pool.apply_async(self.fetch, (url,)))
+			for url in self.urls]
+		pool.close()
+		for i, (url, result) in enumerate(results):
+			# feeds beyond the first workers wait for a free thread
+			deadline = started + self.timeout * (i / workers + 1)
+			try:
+				feed = result.get(max(0, deadline - time.time()))
+				# a broken feed must not cost us the others
+				self.update_feed(url, feed)
+			except multiprocessing.TimeoutError:
+				print("err: Timeout fetching " + url)
+			except Exception as e:
+				print("err: Could not fetch " + url + ": " + str(e))
+
+	def timeline(self):
+		""" entries of all feeds, newest first, each story only once """
+		entries = []
+		for url in self.urls:
+			if url in self.feeds:
+				entries += self.feeds[url]['entries']
+		entries.sort(key=lambda entry: entry[1], reverse=True)
+		seen = set()
+		timeline = []
+		for entry in entries:
+			title = normalize_title(entry[2])
+			if entry[0] in seen or title in seen:
+				continue
+			seen.add(entry[0])
+			seen.add(title)
+			timeline.append(entry)
+		return timeline
+
+	def format_body(self, title, description):
+		""" format title and description into lines of self.width """
+		formatter = lcd_formatter(self.width)
+		return formatter.format(title) + formatter.format(description)
+
+	def format_headline(self, title):
+		""" the title in one line, not wrapped """
+		return ' '.join(lcd_formatter(self.width).format(title))
+
+	def render_body(self, title, description):
+		""" formatted title and description, from the cache if possible """
+		digest = content_hash(title, description)
+		with self.render_lock:
+			body = self.render_cache.pop(digest, None)
+		if body is None:
+			body = self.format_body(title, description)
+		with self.render_lock:
+			if len(self.render_cache) >= RENDER_CACHE_SIZE:
+				self.render_cache.popitem(last=False)
+			self.render_cache[digest] = body
+		return body
+
+	def render(self, entry):
+		""" format a post, the body comes from the cache if possible """
+		key, count, title, description = entry
+		body = self.render_body(title, description)
+		date = time.strftime("%d.%m %H:%M") + ' ' + '[' + str(count) + ']'
+		post = rendered_post([date] + body)
+		post.headline = self.format_headline(title)
+		return post
+
+	def format_post(self, post, count):
+		""" format a post into lines of self.width characters """
+		return self.render((post_key(post), count, post.get('title', u''),
+			post.get('description', u'')))
+
+	def fetch_posts(self):
+		""" get the feed data from the urls. Returns the posts to show as
+		    (post key, count, title, description). """
+		self.fetch_all()
+		now = current_time_millis()
+		timeline = self.timeline()
 		posts_to_print = []
 		posts_to_skip = []
 
-		for post in feed.entries:
-			# if post is already in the database, skip it
-			# TODO check the time
-			title = post.title
-			if self.post_is_in_db_with_old_timestamp(title):
-				posts_to_skip.append(title)
+		for entry in timeline:
+			# skip posts we have seen for longer than limit
+			ts = self.first_seen(entry)
+			if ts is not None and now - ts > self.store.limit:
+				posts_to_skip.append(entry[2])
 			else:
-				posts_to_print.append(post)
+				posts_to_print.append(entry)
 
 		# add all the posts we're going to print to the database with the
 		# current timestamp (but only if they're not already in there)
-		f = open(self.db, 'a')
-		for post in posts_to_print:
-			if not self.post_is_in_db(post.title):
-				f.write(post.title.encode("utf-8") + "|" +
-						str(current_timestamp) + "\n")
-		f.close
-
-		# output all of the new posts
-		count = 1
-		for post in posts_to_print:
-			h2t = html2text.HTML2Text()
-			h2t.inline_links = False
-			h2t.ignore_links = True
-			h2t.ignore_images = True
-			h2t.ignore_emphasis = True
-			h2t.skip_internal_links = True
-			h2t.body_width = self.width
-			text = []
-			date = time.strftime("%d.%m %H:%M") + ' ' + '[' + str(count) + ']'
-			text.append(date)
-
-			title = h2t.handle(post.title)
-			for line in title.split('\n'):
-				if not line.strip():
-					pass
-				else:
-					text.append(str(line.encode('utf-8')))
-
-			# Try to filter out links even before passing to the formatter
-			# Example: <a href='http://earth.google.com/'>world</a>
-			pattern =r'\[*<a.*?>.*?</a>\]*'
-			result = re.sub(pattern , "", post.description)
-	
-			description = h2t.handle(result)
-			for line in description.split('\n'):
-				if line.startswith("  *"):
-					pass
-				elif not line.strip():
-					pass
-				else:
-					text.append(str(line.encode('utf-8')))
-
-			self.text_list.append(text)
-			count += 1
+		self.store.add([entry[0] for entry in posts_to_print], now)
+		self.store.compact_in_background(
+			set(entry[0] for entry in timeline), now)
+
+		self.save_cache()
+		return [(key, count, title, description) for count,
+			(key, published, title, description)
+			in enumerate(posts_to_print, 1)]
+
+	def parse_feeds(self):
+		""" get the feed data from the urls. Returns a list of posts which
+		    are formatted when they are taken out of it. """
+		for entry in self.fetch_posts():
+			self.text_list.append(entry)
 		return self.text_list
 
+# Posts kept ready by post_prefetcher, it fetches again when only
+# PREFETCH_LOW_WATER are left, but not more often than every
+# PREFETCH_INTERVAL seconds
+PREFETCH_CAPACITY = 32
+PREFETCH_LOW_WATER = 4
+PREFETCH_INTERVAL = 60
+
+class post_prefetcher:
+	""" Bounded queue of posts refilled by a background thread. The next
+	    batch is fetched and formatted into a second buffer while the
+	    display still takes posts from the first one. If a snapshot is
+	    given the formatted batch is also put there as screen 'rss'. """
+
+	def __init__(self, reader, capacity=PREFETCH_CAPACITY,
+			low_water=PREFETCH_LOW_WATER, interval=PREFETCH_INTERVAL,
+			snapshot=None):
+		self.reader = reader
+		self.snapshot = snapshot
+		self.capacity = capacity
+		self.low_water = min(low_water, capacity - 1)
+		self.interval = interval
+		self.queue = collections.deque()
+		self.cond = threading.Condition()
+		self.thread = threading.Thread(target=self.run, name="RSS Prefetch")
+		self.thread.daemon = True
+		self.thread.start()
+
+	def __len__(self):
+		with self.cond:
+			return len(self.queue)
+
+	def pop(self):
+		""" next formatted post, None if none is ready yet """
+		with self.cond:
+			if len(self.queue) <= self.low_water + 1:
+				self.cond.notify()
+			if not self.queue:
+				return None
+			entry = self.queue.popleft()
+		return self.reader.render(entry)
+
+	def refill(self):
+		""" fetch and format the next batch, then queue it """
+		batch = []
+		for entry in self.reader.fetch_posts()[:self.capacity]:
+			self.reader.render_body(entry[2], entry[3])
+			batch.append(entry)
+		with self.cond:
+			queued = set(entry[0] for entry in self.queue)
+			for entry in batch:
+				if len(self.queue) >= self.capacity:
+					break
+				if entry[0] not in queued:
+					self.queue.append(entry)
+					queued.add(entry[0])
+		if self.snapshot is not None and batch:
+			self.snapshot.put('rss',
+				[self.reader.render(entry) for entry in batch])
+
+	def run(self):
+		while True:
+			with self.cond:
+				while len(self.queue) > self.low_water:
+					self.cond.wait()
+			try:
+				self.refill()
+			except Exception as e:
+				print("err: Could not prefetch posts: " + str(e))
+			time.sleep(self.interval)
+
 if __name__ == "__main__":
 	rss = rss_reader(url, db, 20)
 	post_list = rss.parse_feeds()
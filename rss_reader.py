@@ -17,36 +17,64 @@ import time
 import sys
 import getopt
 import lcddriver
+import display_lib
 import re
 import subprocess
 import os
 import signal
-import Adafruit_DHT
 import ccu2_lib
 import rss_lib
 import weather_lib
 import sysinfo_lib
-import RPi.GPIO as GPIO
+import snapshot_lib
+import history_lib
 import feedparser
 import thread
 
+# Sensor and button support is only available on the Pi itself
+try:
+	import Adafruit_DHT
+except ImportError:
+	Adafruit_DHT = None
+try:
+	import RPi.GPIO as GPIO
+except ImportError:
+	GPIO = None
+
 # I2C LCD settings
 LCD_WIDTH = 20 		# Zeichen je Zeile
 LCD_HEIGHT = 4      # Zeilen
 
 # RSS feed settings
-feed_url = 'http://www.tagesschau.de/xml/rss2'
+feed_urls = [
+	'http://www.tagesschau.de/xml/rss2',
+]
 feed_db = 'feeds.db'
 
 # DISPLAY Settings
 REFRESH_TIME = 4	# Seconds
+BANNER_TIME = 2		# Seconds
+SCROLL_TIME = 0.3	# Seconds per character
 
 # CCU2 url
 ccu2_url = 'http://homematic-ccu2/config/xmlapi/'
+ccu2_cache = 'ccu2.cache'
+ccu2_history = 'ccu2.history'
+
+# Answers of openweathermap.org, used until they expire
+weather_cache = 'weather.cache'
+
+# Rendered screens are kept here to show something right after a restart
+snapshot_file = 'screens.snap'
+
+# Seconds between background refreshes of the screens
+CCU2_REFRESH = 60
+WEATHER_REFRESH = 60
+SYSINFO_REFRESH = 15
 
 # Temperature Sensor
 dht11_pin = 10
-sensor = Adafruit_DHT.DHT11
+sensor = Adafruit_DHT.DHT11 if Adafruit_DHT else None
 humidity = 0.0
 temperature = 0.0
 
@@ -80,6 +108,9 @@ def MOTION_RISING(pin):
 	#print("  last_motion: " + last_motion)
 
 def init_buttons():
+	if GPIO is None:
+		print("err: RPi.GPIO is missing, buttons and motion sensor are off")
+		return
 	GPIO.setmode(GPIO.BCM)
 	GPIO.setup(PIR_PIN, GPIO.IN)
 	GPIO.setup(SW0_PIN, GPIO.IN)
@@ -97,6 +128,9 @@ def init_buttons():
 # General stuff for debugging
 verbose = False
 
+# Show the headline of each RSS post as a marquee first
+scroll = False
+
 def lcd_banner(lcd):
 	"""" Print title banner, temperature and humidity """
 	try:
@@ -106,7 +140,7 @@ def lcd_banner(lcd):
 		lcd.lcd_display_string("            äöüÄÖÜß°", 3)
 		lcd.lcd_display_string(time.strftime("%d.%m %H:%M") + " " +
 			'{0:0.0f}°C/{1:0.0f}%'.format(temperature, humidity), 4)
-		time.sleep(2)
+		time.sleep(BANNER_TIME)
 	except:
 		print("Hoppla. Es ist etwas schief gelaufen!")
 
@@ -131,14 +165,43 @@ def lcd_print_text(lcd, text):
 			i += 1
 		time.sleep(REFRESH_TIME)
 
-def lcd_temperatures(lcd):
-	global temperature, humidity
+def lcd_load_scroll_text(lcd, text):
+	""" load up to two lines of up to 40 characters for scrolling """
+	lcd.lcd_clear()
+	for ring in range(0, min(len(text), 2)):
+		lcd.lcd_load_ring(text[ring], ring)
+
+def lcd_scroll_text(lcd, text):
+	""" show text as a marquee using the display shift of the LCD.
+	    Line 3 and 4 show the second half of line 1 and 2. """
+	lcd_load_scroll_text(lcd, text)
+	for step in range(0, lcddriver.LCD_DDRAM_WIDTH):
+		time.sleep(SCROLL_TIME)
+		lcd.lcd_shift(1)
+
+def read_temperatures(reader):
+	""" Thermostat lines from the CCU2 """
+	return [reader.read_device_list()]
+
+def read_history(history):
+	""" Sparklines of the thermostat readings """
+	return [history.lines(width=LCD_WIDTH)]
+
+def read_weather(reader):
+	""" Todays weather and forecast lines """
+	return [reader.read_weather()]
+
+def read_statistics():
+	""" System statistics lines """
+	reader = sysinfo_lib.sysinfo_reader()
+	return [reader.read_sysinfo()]
 
-	reader = ccu2_lib.ccu2_reader(ccu2_url)
-	devices = reader.read_device_list()
+def lcd_temperatures(lcd, screens):
+	global temperature, humidity
 
 	# Screen 0 .. n
-	lcd_print_text(lcd, devices)
+	for text in screens.get('temperatures'):
+		lcd_print_text(lcd, text)
 
 	# Screen n + 1
 	lcd.lcd_clear()
@@ -149,18 +212,25 @@ def lcd_temperatures(lcd):
 	lcd.lcd_display_string('Feuchtigkeit: {0:0.1f}%'.format(humidity), 4)
 	time.sleep(REFRESH_TIME)
 
-def lcd_weather(lcd):
-	""" Gather todays weather info and print them on a 4x20 LCD display """
-	reader = weather_lib.weather_reader()
-	weather_list = reader.read_weather()
-	lcd_print_text(lcd, weather_list)
+def lcd_temperature_history(lcd, screens):
+	""" Print the temperature history of each thermostat """
+	lcd.lcd_load_glyphs(history_lib.BAR_GLYPHS)
+	for text in screens.get('history'):
+		lcd_print_text(lcd, text)
+	lcd.lcd_release_glyphs()
 
-def lcd_statistics(lcd):
-	""" Gather system statistics and print them on a 4x20 LCD display """
+def lcd_weather(lcd, screens):
+	""" Print todays weather info on a 4x20 LCD display """
+	for text in screens.get('weather'):
+		lcd_print_text(lcd, text)
+
+def lcd_statistics(lcd, screens):
+	""" Print system statistics on a 4x20 LCD display """
 	
 	global last_motion
-	reader = sysinfo_lib.sysinfo_reader()
-	sysinfo_list = reader.read_sysinfo()
+	sysinfo_list = []
+	for text in screens.get('sysinfo'):
+		sysinfo_list += text
 	sysinfo_list.append(last_motion)
 	lcd_print_text(lcd, sysinfo_list)
 
@@ -175,9 +245,7 @@ segs = [[0b11111, 0b11111, 0b11111, 0b00000, 0b00000, 0b00000, 0b00000, 0b00000]
 		[0b00111, 0b01111, 0b11111, 0b11111, 0b11111, 0b11111, 0b11111, 0b11111]]
 
 def lcd_create_bigfont(lcd):
-	for i in range(8):
-		lcd.lcd_clear()
-		lcd.lcd_create_char(i, segs[i])
+	lcd.lcd_load_glyphs(segs)
 
 # Create digits and stuff from the custom characters
 digits = [["\x07\x00\x01", "\x02\x03\x04"], # 0
@@ -200,12 +268,14 @@ def writeChar(glyph, lines):
 	lines[1] += glyph[1] #+ "\xfe"
 
 # Quick and dirty clock implementation
-def writeTime(lcd):
+def writeTime(lcd, now=None):
 	lines = ["", ""]
-	
-	h = int(time.strftime("%H"))
-	m = int(time.strftime("%M"))
-	s = int(time.strftime("%S"))
+
+	if now is None:
+		now = time.localtime()
+	h = now.tm_hour
+	m = now.tm_min
+	s = now.tm_sec
 	
 	h1 = int(h / 10)
 	h2 = h - (h1 * 10)
@@ -233,6 +303,9 @@ def measure_temperature( threadName, delay):
 		time.sleep(delay)
 
 def init_temperature_measurement():
+	if Adafruit_DHT is None:
+		print("err: Adafruit_DHT is missing, no temperature measurement")
+		return
 	# Create temperature measurement thread
 	try:
 		thread.start_new_thread(measure_temperature, ("Temperature Thread", 5))
@@ -244,20 +317,26 @@ def lcd_bigfont_clock(lcd):
 
 	lcd.lcd_clear()
 	while mode == MODE_CLOCK:
-		lcd.lcd_display_string("      " + time.strftime("%a %d.%m.%Y"), 1)
-		writeTime(lcd)
-		lcd.lcd_display_string('{0:0.0f}°C/{1:0.0f}%'.format(temperature, humidity), 4)
+		lcd_bigfont_clock_frame(lcd)
 		time.sleep(0.10)
 
+def lcd_bigfont_clock_frame(lcd, now=None):
+	""" Draw date, big font time and temperature once """
+	if now is None:
+		now = time.localtime()
+	lcd.lcd_display_string("      " + time.strftime("%a %d.%m.%Y", now), 1)
+	writeTime(lcd, now)
+	lcd.lcd_display_string('{0:0.0f}°C/{1:0.0f}%'.format(temperature, humidity), 4)
+
 def usage():
-	print("rss_ready.py [-h] [-v]")
+	print("rss_ready.py [-h] [-v] [-s]")
 
 def main(argv):
 	global mode
 
 	try:
-		opts, args = getopt.getopt(argv, "rh",
-			[ "help", "verbose" ])
+		opts, args = getopt.getopt(argv, "rhs",
+			[ "help", "verbose", "scroll" ])
 	except getopt.GetoptError:
 		usage()
 		sys.exit(2)
@@ -269,17 +348,42 @@ def main(argv):
 		elif opt in ("-v", "--verbose"):
 			global verbose
 			verbose = True
+		elif opt in ("-s", "--scroll"):
+			global scroll
+			scroll = True
 	source = "".join(args)
 
 	init_temperature_measurement()
 	init_buttons()
 
-	lcd = lcddriver.lcd()
-	lcd.lcd_create_umlaute()
-	lcd_banner(lcd)
+	lcd = display_lib.display_service(lcddriver.lcd())
+
+	# screens of the last run are shown until fresh data is there, all
+	# fetching happens in the background
+	screens = snapshot_lib.screen_snapshot(snapshot_file)
+	screens.save_periodically()
+	history = history_lib.temperature_history(ccu2_history)
+	ccu2 = ccu2_lib.ccu2_reader(ccu2_url, ccu2_cache, history=history)
+	snapshot_lib.screen_refresher(screens, 'temperatures',
+		lambda: read_temperatures(ccu2), CCU2_REFRESH)
+	snapshot_lib.screen_refresher(screens, 'history',
+		lambda: read_history(history), CCU2_REFRESH)
+	# the cache decides when openweathermap.org is asked again
+	weather = weather_lib.weather_reader(
+		cache=weather_lib.response_cache(weather_cache))
+	snapshot_lib.screen_refresher(screens, 'weather',
+		lambda: read_weather(weather), WEATHER_REFRESH)
+	snapshot_lib.screen_refresher(screens, 'sysinfo', read_statistics,
+		SYSINFO_REFRESH)
+
+	# posts are fetched and formatted in the background, the loop only
+	# takes them out of memory
+	rss = rss_lib.rss_reader(feed_urls, feed_db, LCD_WIDTH)
+	posts = rss_lib.post_prefetcher(rss, snapshot=screens)
+	post = None
+	cached_posts = screens.get('rss')
 
-	rss = rss_lib.rss_reader(feed_url, feed_db, LCD_WIDTH)
-	post_list = rss.parse_feeds()
+	lcd_banner(lcd)
 
 	while True:
 		if mode == MODE_CLOCK:
@@ -289,20 +393,27 @@ def main(argv):
 
 		if mode == MODE_RSS:
 			lcd.lcd_clear()
-			lcd.lcd_create_umlaute()
-			if len(post_list) == 0:
-				post_list = rss.parse_feeds()
-			if len(post_list) != 0:
-				post = post_list[0]
-				post_list.pop(0)
+			lcd.lcd_release_glyphs()
+			next_post = posts.pop()
+			if next_post is None and cached_posts:
+				# nothing fetched yet, go through the posts of the last run
+				next_post = cached_posts.pop(0)
+			post = next_post or post
+			if post is None:
+				post = [time.strftime("%d.%m %H:%M"), "Lade Nachrichten..."]
+			if scroll:
+				# posts of the last run are plain lines, no headline
+				headline = getattr(post, 'headline', None) or post[1]
+				lcd_scroll_text(lcd, [headline, post[0]])
 			lcd_print_text(lcd, post)
 
 		if mode == MODE_TEMP:
 			lcd.lcd_clear()
-			lcd.lcd_create_umlaute()
-			lcd_statistics(lcd)
-			lcd_temperatures(lcd)
-			lcd_weather(lcd)
+			lcd.lcd_release_glyphs()
+			lcd_statistics(lcd, screens)
+			lcd_temperatures(lcd, screens)
+			lcd_temperature_history(lcd, screens)
+			lcd_weather(lcd, screens)
 
 if __name__ == "__main__":
 	main(sys.argv[1:])
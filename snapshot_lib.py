@@ -0,0 +1,154 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+#
+# Keeps the rendered screens (RSS posts, thermostats, weather, system
+# info) in memory and in a snapshot file, so that after a restart the
+# first frames can be drawn before any data has been fetched again.
+#
+# A screen is a list of texts, each text a list of lines as passed to
+# lcd_print_text. The snapshot file is written like this:
+#
+#   LCDSNAP1
+#   screen <name> <texts>
+#   text <lines>
+#   u<bytes>
+#   <line as UTF-8>
+#   b<bytes>
+#   <line as str>
+#   ...
+#
+# Lines keep their type (unicode or str), the LCD encodes them differently.
+#
+
+import mmap
+import time
+import threading
+import file_lib
+
+SNAPSHOT_MAGIC = 'LCDSNAP1\n'
+
+# Seconds between writes of the snapshot file, if anything changed
+SNAPSHOT_INTERVAL = 60
+
+def write_line(f, line):
+	if isinstance(line, unicode):
+		kind, data = 'u', line.encode('utf-8')
+	else:
+		kind, data = 'b', str(line)
+	f.write('%s%d\n%s\n' % (kind, len(data), data))
+
+def read_line(m):
+	header = m.readline()
+	size = int(header[1:])
+	data = m.read(size)
+	m.read(1)
+	if header[0] == 'u':
+		return data.decode('utf-8')
+	return data
+
+class screen_snapshot:
+	""" Rendered screens by name, shared between the threads which fetch
+	    them and the display loop """
+
+	def __init__(self, path, interval=SNAPSHOT_INTERVAL):
+		self.path = path
+		self.interval = interval
+		self.screens = {}
+		self.lock = threading.Lock()
+		self.dirty = False
+		self.writer = None
+		self.load()
+
+	def get(self, name):
+		""" texts of a screen, [] if we have none """
+		with self.lock:
+			return list(self.screens.get(name, []))
+
+	def put(self, name, texts):
+		with self.lock:
+			self.screens[name] = [list(text) for text in texts]
+			self.dirty = True
+
+	def load(self):
+		""" read the snapshot file, a missing or broken one is ignored """
+		try:
+			with open(self.path, 'rb') as f:
+				m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		except (IOError, OSError, ValueError):
+			return
+		screens = {}
+		try:
+			if m.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+				raise ValueError("not a snapshot")
+			while m.tell() < m.size():
+				tag, name, count = m.readline().split()
+				texts = []
+				for i in range(int(count)):
+					tag, lines = m.readline().split()
+					texts.append([read_line(m) for j in range(int(lines))])
+				screens[name] = texts
+		except (ValueError, IndexError, UnicodeDecodeError) as e:
+			print("err: Ignoring broken snapshot " + self.path + ": " + str(e))
+			return
+		finally:
+			m.close()
+		with self.lock:
+			self.screens = screens
+
+	def save(self):
+		""" write the snapshot file if a screen changed since the last time """
+		with self.lock:
+			if not self.dirty:
+				return
+			screens = dict(self.screens)
+			self.dirty = False
+		try:
+			with file_lib.atomic_file(self.path, 'wb') as f:
+				f.write(SNAPSHOT_MAGIC)
+				for name, texts in sorted(screens.items()):
+					f.write('screen %s %d\n' % (name, len(texts)))
+					for text in texts:
+						f.write('text %d\n' % len(text))
+						for line in text:
+							write_line(f, line)
+		except (IOError, OSError) as e:
+			print("err: Could not write " + self.path + ": " + str(e))
+			with self.lock:
+				self.dirty = True
+
+	def save_periodically(self):
+		""" write the snapshot every self.interval seconds from a thread """
+		if self.writer is None:
+			self.writer = threading.Thread(target=self.write_loop,
+				name="Snapshot Writer")
+			self.writer.daemon = True
+			self.writer.start()
+		return self.writer
+
+	def write_loop(self):
+		while True:
+			time.sleep(self.interval)
+			self.save()
+
+class screen_refresher:
+	""" Renders a screen every interval seconds in a thread and puts the
+	    texts into the snapshot """
+
+	def __init__(self, snapshot, name, render, interval):
+		self.snapshot = snapshot
+		self.name = name
+		self.render = render
+		self.interval = interval
+		self.thread = threading.Thread(target=self.run,
+			name="Refresh " + name)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def run(self):
+		while True:
+			try:
+				self.snapshot.put(self.name, self.render())
+			except Exception as e:
+				print("err: Could not refresh " + self.name + ": " + str(e))
+			time.sleep(self.interval)
@@ -11,7 +11,11 @@ import subprocess
 import os
 import signal
 import time
-import Adafruit_DHT
+
+try:
+	import Adafruit_DHT
+except ImportError:
+	Adafruit_DHT = None
 
 # DHT11 temperature sensor
 dht11_pin = 10
@@ -30,7 +34,7 @@ class sysinfo_reader:
 	
 	def __init__(self, _dht11_pin=dht11_pin, _ds1820_path=ds1820_path):
 		self.dht11_pin = _dht11_pin
-		self.dht11_sensor = Adafruit_DHT.DHT11
+		self.dht11_sensor = Adafruit_DHT.DHT11 if Adafruit_DHT else None
 		self.ds1820_path = _ds1820_path
 		self.sysinfo_list = []
 			
@@ -13,7 +13,11 @@ import json
 from pprint import pprint
 import datetime
 import codecs
-import urllib2
+import time
+import httplib
+import threading
+import http_lib
+import file_lib
 from time import sleep
 
 def formatTimestamp(timestampString):
@@ -25,20 +29,117 @@ appId = "aaaa3cad3020d0669852eca703e1185bba28"
 todayUrl = 'http://api.openweathermap.org/data/2.5/weather?lat=' + lat + '&lon=' + lon + '&lang=de&units=metric&appid=' + appId
 forecastUrl = 'http://api.openweathermap.org/data/2.5/forecast?lat=' + lat + '&lon=' + lon +  '&lang=de&units=metric&appid=' + appId
 
+# Seconds the answers are used before they are fetched again. The
+# current weather changes every 10 minutes, the forecast every 3 hours.
+TODAY_TTL = 10 * 60
+FORECAST_TTL = 60 * 60
+
+# Seconds to wait before trying again after a failed fetch
+RETRY_INTERVAL = 60
+
+class response_cache:
+	""" Bodies of GET requests by url, in memory and in a file. Expired
+	    ones are returned right away and fetched again in the background,
+	    only a url never fetched before has to wait for the network. """
+
+	def __init__(self, path=None, retry=RETRY_INTERVAL):
+		self.path = path
+		self.retry = retry
+		self.entries = {}
+		self.attempts = {}
+		self.refreshing = set()
+		self.lock = threading.Lock()
+		# one writer of the file at a time, they share the .tmp file
+		self.save_lock = threading.Lock()
+		self.load()
+
+	def load(self):
+		if self.path is None:
+			return
+		try:
+			with open(self.path, 'r') as f:
+				entries = json.load(f)
+		except (IOError, ValueError):
+			return
+		self.entries = dict((url, tuple(entry))
+			for url, entry in entries.items())
+
+	def save(self):
+		if self.path is None:
+			return
+		with self.save_lock:
+			# copied while we hold save_lock, so the last write is newest
+			with self.lock:
+				entries = dict(self.entries)
+			try:
+				with file_lib.atomic_file(self.path) as f:
+					json.dump(entries, f)
+			except (IOError, OSError) as e:
+				print("err: Could not write " + self.path + ": " + str(e))
+
+	def fetch(self, url):
+		""" get url and keep its body, None on errors """
+		try:
+			body = http_lib.get(url).body.decode('utf-8')
+		except (IOError, httplib.HTTPException) as e:
+			print("err: Could not open " + url + ": " + str(e))
+			return None
+		with self.lock:
+			self.entries[url] = (time.time(), body)
+		self.save()
+		return body
+
+	def refresh(self, url):
+		try:
+			self.fetch(url)
+		finally:
+			with self.lock:
+				self.refreshing.discard(url)
+
+	def get(self, url, ttl):
+		""" body of url, fetched again if it is older than ttl seconds """
+		now = time.time()
+		with self.lock:
+			entry = self.entries.get(url)
+			if entry is not None and now - entry[0] < ttl:
+				return entry[1]
+			due = url not in self.refreshing and \
+				now - self.attempts.get(url, 0) >= self.retry
+			if due:
+				self.attempts[url] = now
+			if entry is not None:
+				if due:
+					self.refreshing.add(url)
+					refresher = threading.Thread(target=self.refresh,
+						args=(url,), name="Weather Refresh")
+					refresher.daemon = True
+					refresher.start()
+				return entry[1]
+		if not due:
+			return None
+		return self.fetch(url)
+
 class weather_reader:
 	todayUrl = todayUrl
 	forecastUrl = forecastUrl
 	weather_list = []
 	
-	def __init__(self, _todayUrl=todayUrl, _forecastUrl=forecastUrl):
+	def __init__(self, _todayUrl=todayUrl, _forecastUrl=forecastUrl,
+			cache=None):
 		self.todayUrl = _todayUrl
 		self.forecastUrl = _forecastUrl
+		self.cache = cache
 		self.weather_list = []
 
+	def read(self, url, ttl):
+		""" body of url, through the cache if we have one """
+		if self.cache is None:
+			return http_lib.get(url).body.decode('utf-8')
+		return self.cache.get(url, ttl)
+
 	def read_today(self):
 		try:
-			jsonFile = urllib2.urlopen(self.todayUrl)
-			jsonFileContent = jsonFile.read().decode('utf-8')
+			jsonFileContent = self.read(self.todayUrl, TODAY_TTL)
 			jsonObject = json.loads(jsonFileContent)
 		except:
 			print("err: Could not open " + self.todayUrl)
@@ -70,8 +171,7 @@ class weather_reader:
 
 	def read_forecast(self):
 		try:
-			jsonFile = urllib2.urlopen(self.forecastUrl)
-			jsonFileContent = jsonFile.read().decode('utf-8')
+			jsonFileContent = self.read(self.forecastUrl, FORECAST_TTL)
 			jsonObject = json.loads(jsonFileContent)
 		except:
 			print("err: Could not open " + self.forecastUrl)
@@ -96,6 +196,7 @@ class weather_reader:
 		return self.weather_list
 
 	def read_weather(self):
+		self.weather_list = []
 		self.read_today()
 		self.read_forecast()
 		return self.weather_list